@@ -0,0 +1,18 @@
+"""Import the integration modules without Home Assistant's loader."""
+from __future__ import annotations
+import importlib
+import sys
+import types
+from pathlib import Path
+
+COMPONENT = Path(__file__).resolve().parent.parent / "custom_components" / "CC-301_WB"
+PACKAGE = "cc301_wb"
+
+
+def load(module: str) -> types.ModuleType:
+    """Return a module of the integration, e.g. load("frames")"""
+    if PACKAGE not in sys.modules:
+        package = types.ModuleType(PACKAGE)
+        package.__path__ = [str(COMPONENT)]
+        sys.modules[PACKAGE] = package
+    return importlib.import_module(f"{PACKAGE}.{module}")
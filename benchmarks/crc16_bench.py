@@ -0,0 +1,59 @@
+"""Compare the in-process CRC16 with the former external CRC binary.
+
+Usage:
+    python benchmarks/crc16_bench.py [--crc-binary PATH] [--number N]
+
+The binary is no longer shipped; to compare against it, extract it from an
+older revision, e.g. ``git show <rev>:custom_components/CC-301_WB/CRC > CRC``.
+"""
+from __future__ import annotations
+import argparse
+import os
+import subprocess
+import timeit
+from _component import load
+
+
+def subprocess_crc(binary: str, data: bytes) -> bytes:
+    """The removed code path: fork a shell, run the binary, parse its stdout"""
+    command_line = " ".join(str(num) for num in data)
+    result = subprocess.run(f"'{binary}' {command_line}", shell=True, capture_output=True)
+    result = result.stdout.decode()
+    return bytes((int(result[5:7], 16), int(result[3:5], 16)))
+
+
+def report(name: str, seconds: float, number: int) -> None:
+    print(f"{name:<32} {seconds / number * 1e6:12.2f} us/call")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--crc-binary", help="path to the former CRC executable")
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    crc = load("crc16")
+    request = bytes((1, 3, 46, 0, 0, 0))
+    response = bytes(range(76))
+    response_view = memoryview(response)
+
+    report("crc16 request (6 bytes)", timeit.timeit(lambda: crc.crc16_bytes(request, "big"), number=args.number), args.number)
+    report("crc16 response (76 bytes)", timeit.timeit(lambda: crc.crc16(response_view), number=args.number), args.number)
+
+    def incremental():
+        state = crc.Crc16(response_view[:38])
+        state.update(response_view[38:])
+        return state.value
+
+    report("Crc16 incremental (2 chunks)", timeit.timeit(incremental, number=args.number), args.number)
+
+    if args.crc_binary:
+        binary = os.path.abspath(args.crc_binary)
+        assert subprocess_crc(binary, request) == crc.crc16_bytes(request, "big")
+        number = max(args.number // 100, 10)
+        report("subprocess request (6 bytes)", timeit.timeit(lambda: subprocess_crc(binary, request), number=number), number)
+        report("subprocess response (76 bytes)", timeit.timeit(lambda: subprocess_crc(binary, response), number=number), number)
+
+
+if __name__ == "__main__":
+    main()
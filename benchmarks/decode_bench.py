@@ -0,0 +1,51 @@
+"""Compare CC-301 response decoding: per-float slicing vs a precompiled struct.
+
+Usage:
+    python benchmarks/decode_bench.py [--number N]
+"""
+from __future__ import annotations
+import argparse
+import random
+import struct
+import timeit
+from _component import load
+
+frames = load("frames")
+registers = load("registers")
+BLOCK = registers.BLOCKS[0]
+MAPPED = (1, 2, 3, 4, 9, 10, 11)
+
+
+def decode_loop(line) -> list:
+    """The former ElectricMeter.unpack_data: a slice and struct.unpack per float"""
+    unpacked_data = []
+    index = 0
+    while index + 4 < 78:
+        unpacked_data.append(struct.unpack('f', line[index:index + 4])[0])
+        index += 4
+    return [unpacked_data[i] for i in MAPPED]
+
+
+def decode_struct(line) -> tuple:
+    return BLOCK.decoder.unpack_from(line)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=200000)
+    args = parser.parse_args()
+
+    frame = bytearray(frames.INSTANT_VALUES_RESPONSE_LENGTH)
+    for index in range(1, 19):
+        struct.pack_into("<f", frame, 4 * index, random.uniform(0, 250))
+    view = memoryview(frame)
+    assert list(decode_struct(view)) == decode_loop(frame)
+
+    for name, decode, line in (("slice + struct.unpack loop", decode_loop, frame),
+                               ("Struct.unpack_from(memoryview)", decode_struct, view)):
+        seconds = timeit.timeit(lambda: decode(line), number=args.number)
+        print(f"{name:<32} {seconds / args.number * 1e9:10.0f} ns/frame")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""Measure poll throughput, toggle latency, loop lag and CPU against simulated gateways.
+
+Usage:
+    python benchmarks/poll_bench.py [--hubs 1,10,50] [--coils 32] [--duration 10]
+                                    [--interval 0.5] [--toggle-interval 1] [--latency S]
+                                    [--baudrate N] [--output results.json]
+
+Every hub gets its own simulated gateway with one CC-301 and one WB-MR module.
+The gateways run in a child process, so the CPU time reported is the one of
+the integration, the toggles and a 10 ms loop lag probe. A toggle counts as confirmed once the relay module
+acknowledged the write and the switcher reports the new state.
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import platform
+import random
+import statistics
+import subprocess
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+from _component import COMPONENT, load
+
+const = load("const")
+hub_module = load("hub")
+
+LAG_PROBE = 0.01
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Return the nearest-rank percentile, 0 for no values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summary(values: List[float]) -> Dict[str, float]:
+    """Return count, p50, p99, maximum and mean in milliseconds"""
+    return {"count": len(values),
+            "p50_ms": percentile(values, 0.5) * 1e3,
+            "p99_ms": percentile(values, 0.99) * 1e3,
+            "max_ms": max(values, default=0.0) * 1e3,
+            "mean_ms": statistics.fmean(values) * 1e3 if values else 0.0}
+
+
+def run_gateways(count: int, coils: int, faults: Dict[str, Any], ports, stop, stats) -> None:
+    """Child process: serve count simulated gateways until stop is set"""
+    import simulator
+
+    async def serve() -> None:
+        gateways = [simulator.GatewaySimulator((5,), ((1, coils),), simulator.Faults(**faults))
+                    for _ in range(count)]
+        for gateway in gateways:
+            ports.put(await gateway.start())
+        while not stop.is_set():
+            await asyncio.sleep(0.1)
+        for gateway in gateways:
+            await gateway.stop()
+        stats.put([gateway.stats for gateway in gateways])
+
+    asyncio.run(serve())
+
+
+async def probe_lag(lags: List[float]) -> None:
+    """Record how late the loop wakes up a sleeping task"""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LAG_PROBE
+        await asyncio.sleep(LAG_PROBE)
+        lags.append(max(0.0, loop.time() - expected))
+
+
+async def toggle(hub, interval: float, latencies: List[float], failures: List[int]) -> None:
+    """Switch random coils of the hub relay module and time each one"""
+    switcher = hub.relays[0].modbus_switcher
+    coils = hub.relays[0].count_of_coils
+    await asyncio.sleep(random.uniform(0, interval))
+    while True:
+        coil = random.randrange(coils)
+        started = time.perf_counter()
+        try:
+            if switcher.is_on(coil):
+                await switcher.turn_off(coil)
+            else:
+                await switcher.turn_on(coil)
+            latencies.append(time.perf_counter() - started)
+        except Exception:
+            failures[0] += 1
+        await asyncio.sleep(interval)
+
+
+async def measure(ports: List[int], args: argparse.Namespace) -> Dict[str, Any]:
+    """Run one hub per gateway for the configured duration"""
+    options = {const.CONF_METER_INTERVAL: args.interval, const.CONF_SWITCH_INTERVAL: args.interval}
+    polls = [0]
+
+    def counted(poll):
+        async def wrapper():
+            result = await poll()
+            polls[0] += 1
+            return result
+        return wrapper
+
+    def listener():
+        pass
+
+    hubs = []
+    for index, port in enumerate(ports):
+        hub = hub_module.Hub(None, f"bench_{index}", "127.0.0.1", str(port), ["5"], [[1, args.coils]], options)
+        # Devices are only polled while entities listen, stand in for them
+        for meter in hub.meters:
+            for field in meter.electric_meter.FIELDS:
+                meter.register_callback(listener, field)
+        for relay in hub.relays:
+            for coil in range(relay.count_of_coils):
+                relay.register_callback(listener, coil)
+        for target in hub.poller.targets.values():
+            target.poll = counted(target.poll)
+        hubs.append(hub)
+
+    lags: List[float] = []
+    latencies: List[float] = []
+    failures = [0]
+    loop = asyncio.get_running_loop()
+    helpers = [loop.create_task(probe_lag(lags))]
+    for hub in hubs:
+        helpers.append(loop.create_task(toggle(hub, args.toggle_interval, latencies, failures)))
+
+    # Let the connections open before measuring
+    await asyncio.sleep(1)
+    lags.clear()
+    latencies.clear()
+    polls[0] = 0
+    transactions = sum(hub.connection.opened + hub.connection.reused for hub in hubs)
+    cpu = time.process_time()
+    started = time.perf_counter()
+    await asyncio.sleep(args.duration)
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu
+    transactions = sum(hub.connection.opened + hub.connection.reused for hub in hubs) - transactions
+
+    for task in helpers:
+        task.cancel()
+    await asyncio.gather(*helpers, return_exceptions=True)
+    for hub in hubs:
+        await hub.async_close()
+
+    return {"hubs": len(hubs),
+            "elapsed_s": elapsed,
+            "transactions": transactions,
+            "transactions_per_s_per_gateway": transactions / elapsed / len(hubs),
+            "polls": polls[0],
+            "cpu_s": cpu,
+            "cpu_ms_per_poll": cpu / polls[0] * 1e3 if polls[0] else 0.0,
+            "cpu_utilization": cpu / elapsed,
+            "toggle_latency": summary(latencies),
+            "toggle_failures": failures[0],
+            "loop_lag": summary(lags)}
+
+
+def run_scale(hubs: int, args: argparse.Namespace) -> Dict[str, Any]:
+    """Start the gateways of one scale step and measure the hubs against them"""
+    context = multiprocessing.get_context("spawn")
+    ports, stats, stop = context.Queue(), context.Queue(), context.Event()
+    faults = {"latency": args.latency, "jitter": args.jitter, "baudrate": args.baudrate}
+    child = context.Process(target=run_gateways, args=(hubs, args.coils, faults, ports, stop, stats))
+    child.start()
+    try:
+        result = asyncio.run(measure([ports.get(timeout=30) for _ in range(hubs)], args))
+    finally:
+        stop.set()
+    gateway_stats = stats.get(timeout=30)
+    child.join()
+    result["gateways"] = {key: sum(item[key] for item in gateway_stats) for key in gateway_stats[0]}
+    return result
+
+
+def environment() -> Dict[str, Any]:
+    """Return what the results depend on besides the code"""
+    import pymodbus
+    manifest = json.loads((COMPONENT / "manifest.json").read_text())
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=COMPONENT, capture_output=True,
+                                  text=True).stdout.strip()
+    except OSError:
+        revision = ""
+    return {"version": manifest.get("version"),
+            "revision": revision,
+            "python": platform.python_version(),
+            "pymodbus": pymodbus.__version__,
+            "machine": platform.machine(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z")}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--hubs", default="1,10,50", help="comma separated hub counts to run")
+    parser.add_argument("--coils", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10, help="measured seconds per hub count")
+    parser.add_argument("--interval", type=float, default=0.5, help="meter and relay poll interval, s")
+    parser.add_argument("--toggle-interval", type=float, default=1, help="pause between toggles per hub, s")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated device reaction time, s")
+    parser.add_argument("--jitter", type=float, default=0.0, help="spread of the reaction time, s")
+    parser.add_argument("--baudrate", type=int, default=0, help="simulated bus speed, 0 for no line time")
+    parser.add_argument("--output", type=Path, help="JSON file for the results")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+
+    results = {"environment": environment(),
+               "parameters": {key: value for key, value in vars(args).items() if key != "output"},
+               "runs": []}
+    for hubs in (int(item) for item in args.hubs.split(",")):
+        run = run_scale(hubs, args)
+        results["runs"].append(run)
+        print(f"{hubs:3} hubs: {run['transactions_per_s_per_gateway']:8.1f} tx/s/gateway, "
+              f"toggle p50 {run['toggle_latency']['p50_ms']:6.1f} ms p99 {run['toggle_latency']['p99_ms']:6.1f} ms, "
+              f"loop lag p99 {run['loop_lag']['p99_ms']:5.1f} ms, {run['cpu_ms_per_poll']:.3f} ms CPU/poll")
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2, default=str))
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
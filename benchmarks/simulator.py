@@ -0,0 +1,282 @@
+"""Simulated TCP-to-RS485 gateway with CC-301 meters and WB-MR relay modules.
+
+Usage:
+    python benchmarks/simulator.py [--port 5020] [--meters 5,6] [--relays 1:32,2:6]
+                                   [--baudrate 9600] [--latency S] [--jitter S] [--drop P]
+                                   [--corrupt P] [--split P] [--truncate P] [--stream]
+
+The gateway forwards every request to one shared bus, like the real one: the
+meters answer CC-301 commands with big-endian CRC frames, the relay modules
+answer Modbus RTU read_coils, write_coil and write_coils.
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import math
+import random
+import struct
+from typing import Dict, Iterable, Optional, Set, Tuple
+from _component import load
+
+crc16 = load("crc16")
+frames = load("frames")
+registers = load("registers")
+
+MODBUS_CRC_BYTEORDER = "little"
+READ_COILS = 1
+WRITE_COIL = 5
+WRITE_COILS = 15
+ILLEGAL_ADDRESS = 2
+
+
+class Faults:
+    """Timing and failures applied to every answer"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, drop: float = 0.0, corrupt: float = 0.0,
+                 split: float = 0.0, truncate: float = 0.0, baudrate: int = 0, stream: bool = False) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.drop = drop
+        self.corrupt = corrupt
+        self.split = split
+        self.truncate = truncate
+        self.baudrate = baudrate
+        # Forward each answer as the bus carries it, like a transparent gateway, instead of whole frames
+        self.stream = stream
+
+    def line_time(self, size: int) -> float:
+        """Return the time the bus needs to carry size bytes, 10 bits each"""
+        return size * 10 / self.baudrate if self.baudrate else 0.0
+
+    def delay(self) -> float:
+        """Return the device reaction time"""
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+
+class SimulatedMeter:
+    """CC-301 with slowly wandering measurements"""
+
+    def __init__(self, address: int) -> None:
+        self.address = address
+        self._values = {register.name: self._initial(register) for register in registers.REGISTERS}
+
+    @staticmethod
+    def _initial(register) -> float:
+        return {"voltage": 230.0, "frequency": 50.0, "power_factor": 0.95, "current": 2.0,
+                "energy": 1000.0}.get(register.device_class, 500.0) / register.scale
+
+    def answer(self, request: bytes) -> Optional[bytes]:
+        """Return the response frame, None for an unknown command"""
+        command = tuple(request[1:-2])
+        blocks = [block for block in registers.BLOCKS if block.command == command]
+        if not blocks:
+            return None
+        block = blocks[0]
+        frame = bytearray(block.response_length)
+        frame[0:4] = bytes((self.address, command[0], command[1], 0))
+        for register in block.registers:
+            value = self._values[register.name]
+            if register.state_class == registers.TOTAL_INCREASING:
+                value += random.uniform(0, 0.01)
+            else:
+                value *= 1 + random.uniform(-0.002, 0.002)
+            self._values[register.name] = value
+            struct.pack_into("<f", frame, register.offset, value)
+        frame[-2:] = crc16.crc16_bytes(memoryview(frame)[:-2], frames.CRC_BYTEORDER)
+        return bytes(frame)
+
+
+class SimulatedRelay:
+    """WB-MR relay module"""
+
+    def __init__(self, slave_id: int, count_of_coils: int) -> None:
+        self.slave_id = slave_id
+        self.count_of_coils = count_of_coils
+        self.states = 0
+
+    def answer(self, request: bytes) -> bytes:
+        """Return the Modbus RTU response frame"""
+        function = request[1]
+        start, quantity = struct.unpack_from(">HH", request, 2)
+        if function == WRITE_COIL:
+            quantity = 1
+        if start + quantity > self.count_of_coils:
+            return _modbus_frame(bytes((self.slave_id, function | 0x80, ILLEGAL_ADDRESS)))
+
+        if function == READ_COILS:
+            states = self.states >> start & ((1 << quantity) - 1)
+            data = states.to_bytes(math.ceil(quantity / 8), "little")
+            return _modbus_frame(bytes((self.slave_id, function, len(data))) + data)
+        if function == WRITE_COIL:
+            self._write(start, 1, request[4] == 0xFF)
+            return bytes(request)
+        states = int.from_bytes(request[7:7 + request[6]], "little")
+        self._write(start, quantity, states)
+        return _modbus_frame(bytes(request[:6]))
+
+    def _write(self, start: int, quantity: int, states: int) -> None:
+        mask = ((1 << quantity) - 1) << start
+        self.states = (self.states & ~mask) | ((int(states) << start) & mask)
+
+
+def _modbus_frame(payload: bytes) -> bytes:
+    return payload + crc16.crc16_bytes(payload, MODBUS_CRC_BYTEORDER)
+
+
+class GatewaySimulator:
+    """TCP server passing every request to one simulated RS485 bus"""
+
+    def __init__(self, meters: Iterable[int] = (5,), relays: Iterable[Tuple[int, int]] = ((1, 32),),
+                 faults: Faults | None = None) -> None:
+        self.meters: Dict[int, SimulatedMeter] = {address: SimulatedMeter(address) for address in meters}
+        self.relays: Dict[int, SimulatedRelay] = {slave_id: SimulatedRelay(slave_id, count)
+                                                  for slave_id, count in relays}
+        self.faults = faults or Faults()
+        self.stats = {"requests": 0, "answered": 0, "dropped": 0, "corrupted": 0, "split": 0, "truncated": 0,
+                      "bad_requests": 0}
+        self._bus = asyncio.Lock()
+        self._server: asyncio.AbstractServer | None = None
+        self._clients: Set[asyncio.Task] = set()
+
+    @property
+    def port(self) -> int:
+        """Return the port the server listens on"""
+        return self._server.sockets[0].getsockname()[1]
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        """Start listening and return the port, a free one by default"""
+        self._server = await asyncio.start_server(self._serve, host, port)
+        return self.port
+
+    async def stop(self) -> None:
+        """Stop listening and close the client connections"""
+        if self._server is not None:
+            self._server.close()
+            for task in self._clients:
+                task.cancel()
+            await asyncio.gather(*self._clients, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._clients.add(task)
+        try:
+            while True:
+                request = await self._read_request(reader)
+                async with self._bus:
+                    await self._exchange(request, writer)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._clients.discard(task)
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> bytes:
+        head = await reader.readexactly(2)
+        if head[0] not in self.meters and head[1] == WRITE_COILS:
+            head += await reader.readexactly(5)
+            return head + await reader.readexactly(head[6] + 2)
+        # CC-301 commands and the other Modbus requests are eight bytes long
+        return head + await reader.readexactly(6)
+
+    def _answer(self, request: bytes) -> Optional[bytes]:
+        address = request[0]
+        if address in self.meters:
+            if not crc16.check_crc(request, frames.CRC_BYTEORDER):
+                return None
+            return self.meters[address].answer(request)
+        if address in self.relays:
+            if not crc16.check_crc(request, MODBUS_CRC_BYTEORDER):
+                return None
+            return self.relays[address].answer(request)
+        return None
+
+    async def _exchange(self, request: bytes, writer: asyncio.StreamWriter) -> None:
+        faults = self.faults
+        self.stats["requests"] += 1
+        await asyncio.sleep(faults.line_time(len(request)) + faults.delay())
+        response = self._answer(request)
+        if response is None:
+            # Devices stay silent on a bad crc or an unknown address
+            self.stats["bad_requests"] += 1
+            return
+        if random.random() < faults.drop:
+            self.stats["dropped"] += 1
+            return
+
+        if random.random() < faults.corrupt:
+            self.stats["corrupted"] += 1
+            corrupted = bytearray(response)
+            corrupted[random.randrange(len(corrupted))] ^= 1 << random.randrange(8)
+            response = bytes(corrupted)
+        if random.random() < faults.truncate:
+            self.stats["truncated"] += 1
+            response = response[:random.randrange(1, len(response))]
+
+        line_time = faults.line_time(len(response))
+        if len(response) > 1 and random.random() < faults.split:
+            # The gateway forwards what it has received so far
+            self.stats["split"] += 1
+            cut = random.randrange(1, len(response))
+            writer.write(response[:cut])
+            await writer.drain()
+            await asyncio.sleep(max(line_time, 0.005))
+            writer.write(response[cut:])
+        elif faults.stream and len(response) > 1:
+            await asyncio.sleep(faults.line_time(1))
+            writer.write(response[:1])
+            await writer.drain()
+            await asyncio.sleep(line_time - faults.line_time(1))
+            writer.write(response[1:])
+        else:
+            await asyncio.sleep(line_time)
+            writer.write(response)
+        await writer.drain()
+        self.stats["answered"] += 1
+
+
+def parse_relays(value: str) -> Tuple[Tuple[int, int], ...]:
+    """Parse slave_id:count_of_coils pairs"""
+    return tuple((int(slave_id), int(count)) for slave_id, count in
+                 (item.split(":") for item in value.split(",") if item.strip()))
+
+
+async def serve(args: argparse.Namespace) -> None:
+    faults = Faults(args.latency, args.jitter, args.drop, args.corrupt, args.split, args.truncate, args.baudrate,
+                    args.stream)
+    simulator = GatewaySimulator((int(item) for item in args.meters.split(",") if item.strip()),
+                                 parse_relays(args.relays), faults)
+    port = await simulator.start(args.host, args.port)
+    print(f"Simulated gateway on {args.host}:{port}, meters {sorted(simulator.meters)}, "
+          f"relays {sorted(simulator.relays)}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await simulator.stop()
+        print(simulator.stats)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5020)
+    parser.add_argument("--meters", default="5", help="comma separated CC-301 addresses")
+    parser.add_argument("--relays", default="1:32", help="comma separated slave_id:count_of_coils")
+    parser.add_argument("--baudrate", type=int, default=0, help="bus speed, 0 for no line time")
+    parser.add_argument("--latency", type=float, default=0.0, help="device reaction time, s")
+    parser.add_argument("--jitter", type=float, default=0.0, help="uniform spread of the reaction time, s")
+    parser.add_argument("--drop", type=float, default=0.0, help="probability of no answer")
+    parser.add_argument("--corrupt", type=float, default=0.0, help="probability of a flipped bit")
+    parser.add_argument("--split", type=float, default=0.0, help="probability of an answer in two chunks")
+    parser.add_argument("--truncate", type=float, default=0.0, help="probability of a cut off answer")
+    parser.add_argument("--stream", action="store_true", help="forward answers byte by byte, not as whole frames")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
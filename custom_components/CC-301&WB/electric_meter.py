@@ -2,7 +2,10 @@ import struct
 import threading
 from typing import List
 import serial
-from subprocess import run
+from .crc16 import crc16, crc16_bytes
+
+# CC-301 transmits the CRC high byte first, unlike Modbus RTU
+CRC_BYTEORDER = "big"
 
 
 class ElectricMeter:
@@ -53,22 +56,8 @@ class ElectricMeter:
 
     def prepare_command(self) -> bytearray:
         """Calculating and adding crc"""
-        numbers = []
-        for el in self._command.split(" "):
-            numbers.append(int(el))
-
-        command_line = ""
-        packet = bytearray()
-
-        for num in numbers:
-            packet.append(num)
-            command_line += str(num) + " "
-
-        result = run(f"'./custom_components/CC-301/CRC' {command_line}", shell=True, capture_output=True)
-        result = result.stdout.decode()
-        packet.append(int("0x" + result[5:7], 16))
-        packet.append(int("0x" + result[3:5], 16))
-
+        packet = bytearray(int(el) for el in self._command.split(" "))
+        packet += crc16_bytes(packet, CRC_BYTEORDER)
         return packet
 
     def get_data(self, packet) -> bytes:
@@ -96,20 +85,8 @@ class ElectricMeter:
     @staticmethod
     def check_crc(response) -> bool:
         """Check crc from response"""
-        command_line = ""
-
-        for num in response[:76]:
-            command_line += str(num) + " "
-
-        result = run(f"'./custom_components/CC-301/CRC' {command_line}", shell=True, capture_output=True)
-        result = result.stdout.decode()
-
-        first_crc_response_byte = "0x" + result[5:7]
-        second_crc_response_byte = "0x" + result[3:5]
-        first_crc_check_byte = hex(response[76])
-        second_crc_check_byte = hex(response[77])
-
-        return first_crc_response_byte == first_crc_check_byte and second_crc_response_byte == second_crc_check_byte
+        view = memoryview(response)
+        return crc16(view[:76]) == int.from_bytes(view[76:78], CRC_BYTEORDER)
 
     @staticmethod
     def check_response(response) -> bool:
@@ -44,6 +44,13 @@ class Hub:
         """Return hub id."""
         return self._id
 
+    async def async_close(self) -> None:
+        """Stop the polling of every device"""
+        tasks = [device.task for device in self.devices]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
 
 class Meter:
     """Device responsible for electric meter"""
@@ -57,7 +64,7 @@ class Meter:
         self._manufacturer = "Gran Electro"
         self._callbacks = set()
         self._loop = asyncio.get_event_loop()
-        self._loop.create_task(self.update())
+        self._task = self._loop.create_task(self.update())
 
     @property
     def model(self) -> str:
@@ -69,6 +76,11 @@ class Meter:
         """Return the device manufacturer"""
         return self._manufacturer
 
+    @property
+    def task(self) -> asyncio.Task:
+        """Return the task polling the device"""
+        return self._task
+
     @property
     def id(self) -> str:
         """Return id for electric meter"""
@@ -121,7 +133,7 @@ class ModbusDevice:
         self._switches = []
         self._callbacks = set()
         self._loop = asyncio.get_event_loop()
-        self._loop.create_task(self.update())
+        self._task = self._loop.create_task(self.update())
 
     @property
     def model(self) -> str:
@@ -143,6 +155,11 @@ class ModbusDevice:
         """Returns the device name"""
         return self._name
 
+    @property
+    def task(self) -> asyncio.Task:
+        """Return the task polling the device"""
+        return self._task
+
     @property
     def id(self) -> str:
         """Returns the device id"""
@@ -1,23 +1,94 @@
 """The Detailed Hello World Push integration."""
 from __future__ import annotations
+import voluptuous as vol
 from homeassistant.config_entries import ConfigEntry
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, ServiceCall, callback
+from homeassistant.exceptions import HomeAssistantError
+from homeassistant.helpers import device_registry as dr, entity_registry as er
 from .hub import Hub
-from .const import DOMAIN
+from .const import CONF_DEVICE_IDS, CONF_RELAYS, DOMAIN, SERVICE_SET_COILS
+from .frames import REQUEST_FRAMES
+from .registers import REGISTERS
 
 PLATFORMS: list[str] = ["sensor", "light"]
 
+SET_COILS_SCHEMA = vol.Schema({vol.Required("hub"): str,
+                               vol.Optional("slave_id"): vol.Coerce(int),
+                               vol.Required("states"): vol.Coerce(int),
+                               vol.Optional("mask"): vol.Coerce(int)})
+
 
 async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     """Set up Hub from config entry"""
-    hass.data.setdefault(DOMAIN, {})[entry.entry_id] = Hub(hass,
-                                                           entry.data["device_name"],
-                                                           entry.data["device_id"],
-                                                           entry.data["host"],
-                                                           entry.data["port"],
-                                                           entry.data["slave_id"],
-                                                           entry.data["count_of_coils"])
+    hub = hass.data.setdefault(DOMAIN, {})[entry.entry_id] = Hub(hass,
+                                                                 entry.data["device_name"],
+                                                                 entry.data["host"],
+                                                                 entry.data["port"],
+                                                                 entry.data[CONF_DEVICE_IDS],
+                                                                 entry.data[CONF_RELAYS],
+                                                                 entry.options)
+    data = dict(entry.data)
+
+    async def async_update_entry(hass: HomeAssistant, entry: ConfigEntry) -> None:
+        """Apply new options in place, reload when the devices changed"""
+        if dict(entry.data) != data:
+            REQUEST_FRAMES.invalidate()
+            await hass.config_entries.async_reload(entry.entry_id)
+        else:
+            hub.apply_options(entry.options)
+
+    entry.async_on_unload(entry.add_update_listener(async_update_entry))
     await hass.config_entries.async_forward_entry_setups(entry, PLATFORMS)
+
+    if not hass.services.has_service(DOMAIN, SERVICE_SET_COILS):
+        async def async_set_coils(call: ServiceCall) -> None:
+            """Switch several coils of a relay module with one frame"""
+            hub_id = call.data["hub"].lower()
+            for hub in hass.data[DOMAIN].values():
+                if hub.hub_id == hub_id:
+                    device = hub.relay(call.data.get("slave_id"))
+                    if device is None:
+                        raise HomeAssistantError(f"Hub {call.data['hub']} has no relay module {call.data.get('slave_id')}")
+                    mask = call.data.get("mask", (1 << device.count_of_coils) - 1)
+                    await device.set_coils(call.data["states"], mask)
+                    return
+            raise HomeAssistantError(f"Unknown hub {call.data['hub']}")
+
+        hass.services.async_register(DOMAIN, SERVICE_SET_COILS, async_set_coils, schema=SET_COILS_SCHEMA)
+    return True
+
+
+async def async_migrate_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
+    """Turn the single meter and relay module of a version 1 entry into device lists"""
+    if entry.version == 1:
+        data = dict(entry.data)
+        host = data["host"].lower()
+        name = data["device_name"]
+        device_id = data.pop("device_id")
+        slave_id = data.pop("slave_id")
+        count_of_coils = data.pop("count_of_coils")
+        data[CONF_DEVICE_IDS] = [device_id]
+        data[CONF_RELAYS] = [[slave_id, count_of_coils]]
+
+        # Ids now carry the device address so that several devices fit in one hub
+        meter_id = f"electric_meter_{host}_{device_id}"
+        switcher_id = f"modbus_switcher_{host}_{slave_id}"
+        unique_ids = {f"{name}_{register.name}": f"{meter_id}_{register.name}" for register in REGISTERS}
+        unique_ids.update({f"{name}__{coil}": f"{switcher_id}_{coil}" for coil in range(count_of_coils)})
+
+        @callback
+        def migrate_unique_id(entity_entry: er.RegistryEntry) -> dict | None:
+            unique_id = unique_ids.get(entity_entry.unique_id)
+            return {"new_unique_id": unique_id} if unique_id else None
+
+        await er.async_migrate_entries(hass, entry.entry_id, migrate_unique_id)
+        device_registry = dr.async_get(hass)
+        for old_id, new_id in ((f"electric_meter_{host}", meter_id), (f"modbus_switcher_{host}", switcher_id)):
+            device = device_registry.async_get_device(identifiers={(DOMAIN, old_id)})
+            if device is not None:
+                device_registry.async_update_device(device.id, new_identifiers={(DOMAIN, new_id)})
+
+        hass.config_entries.async_update_entry(entry, data=data, version=2)
     return True
 
 
@@ -25,5 +96,8 @@ async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     """Unload a config entry"""
     unload_ok = await hass.config_entries.async_unload_platforms(entry, PLATFORMS)
     if unload_ok:
-        hass.data[DOMAIN].pop(entry.entry_id)
+        hub = hass.data[DOMAIN].pop(entry.entry_id)
+        await hub.async_close()
+        if not hass.data[DOMAIN]:
+            hass.services.async_remove(DOMAIN, SERVICE_SET_COILS)
     return unload_ok
@@ -0,0 +1,97 @@
+"""Incremental assembly of CC-301 response frames from a byte stream."""
+from __future__ import annotations
+import logging
+from typing import Dict
+from .crc16 import check_crc
+from .frames import CRC_BYTEORDER
+
+_LOGGER = logging.getLogger(__name__)
+
+CAPACITY = 256
+
+
+class FrameAssembler:
+    """Collects received bytes in one reusable buffer and cuts whole frames out of them
+
+    A frame starts with the header of the request it answers (address, function
+    and parameter) and is accepted once it is complete and its crc matches.
+    Bytes in front of it are stale or garbled and are skipped; every skip is
+    counted as a resynchronization.
+    """
+
+    def __init__(self, capacity: int = CAPACITY) -> None:
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self.resyncs = 0
+        self.discarded = 0
+
+    def __len__(self) -> int:
+        return self._end - self._start
+
+    def feed(self, data: bytes) -> None:
+        """Append received bytes"""
+        size = len(data)
+        if self._end + size > len(self._buffer):
+            # Move the pending bytes to the front, growing the buffer only if they still do not fit
+            pending = bytes(self._view[self._start:self._end])
+            if len(pending) + size > len(self._buffer):
+                self._buffer = bytearray(max(2 * len(self._buffer), len(pending) + size))
+                self._view = memoryview(self._buffer)
+            self._buffer[:len(pending)] = pending
+            self._start, self._end = 0, len(pending)
+        self._buffer[self._end:self._end + size] = data
+        self._end += size
+
+    def partial(self, header: bytes) -> bytes:
+        """Return the received part of an incomplete frame, empty if none started"""
+        position = self._buffer.find(header, self._start, self._end)
+        return bytes(self._view[position:self._end]) if position >= 0 else b""
+
+    def reset(self) -> None:
+        """Drop everything received so far with the stream it came from"""
+        self._start = self._end = 0
+
+    def clear(self) -> None:
+        """Drop everything received so far, counting it as stale"""
+        if self._end > self._start:
+            self._skip(self._end - self._start, "stale bytes before the request")
+        self._start = self._end = 0
+
+    def next_frame(self, header: bytes, length: int) -> bytes | None:
+        """Return the next frame of length bytes starting with header, None while it is incomplete
+
+        A complete candidate with a wrong crc is skipped while a later header is
+        buffered; the last one is returned as is, so the caller reports the crc
+        failure at once instead of waiting for a timeout.
+        """
+        while True:
+            position = self._buffer.find(header, self._start, self._end)
+            if position < 0:
+                # Keep a tail that may be the beginning of a header
+                keep = min(len(header) - 1, self._end - self._start)
+                if self._end - keep > self._start:
+                    self._skip(self._end - keep - self._start, "no frame header")
+                return None
+            if position > self._start:
+                self._skip(position - self._start, "garbage before the frame header")
+            if self._end - position < length:
+                return None
+            frame = self._view[position:position + length]
+            if check_crc(frame, CRC_BYTEORDER) or self._buffer.find(header, position + 1, self._end) < 0:
+                self._start = position + length
+                if self._start == self._end:
+                    self._start = self._end = 0
+                return bytes(frame)
+            self._skip(1, "frame with a wrong crc")
+
+    def stats(self) -> Dict[str, int]:
+        """Return how often the stream was resynchronized and how many bytes were skipped"""
+        return {"resyncs": self.resyncs, "discarded_bytes": self.discarded}
+
+    def _skip(self, size: int, reason: str) -> None:
+        self.resyncs += 1
+        self.discarded += size
+        self._start += size
+        _LOGGER.debug(f"Resynchronized the response stream, skipped {size} bytes: {reason}")
@@ -0,0 +1,104 @@
+"""Circuit breaker that fails the transactions of an unreachable gateway fast."""
+from __future__ import annotations
+import asyncio
+import logging
+from typing import Callable, Set
+
+_LOGGER = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Consecutive transport failures that open the breaker
+FAILURE_THRESHOLD = 3
+# Time until the first probe, doubled after every failed probe
+RESET_TIMEOUT = 5
+MAX_RESET_TIMEOUT = 60
+
+
+class GatewayUnavailable(Exception):
+    """Error to indicate a transaction was refused because the gateway is unreachable"""
+
+
+class CircuitBreaker:
+    """Closed while the gateway answers, open after repeated failures, half-open while one probe runs"""
+
+    def __init__(self, name: str, failure_threshold: int = FAILURE_THRESHOLD, reset_timeout: float = RESET_TIMEOUT,
+                 max_reset_timeout: float = MAX_RESET_TIMEOUT) -> None:
+        self._name = name
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._max_reset_timeout = max_reset_timeout
+        self._state = CLOSED
+        self._failures = 0
+        self._opened = 0
+        self._timeout = reset_timeout
+        self._retry_at = 0.0
+        self._listeners: Set[Callable[[str], None]] = set()
+
+    @property
+    def state(self) -> str:
+        """Return closed, open or half_open"""
+        return self._state
+
+    @property
+    def retry_at(self) -> float:
+        """Return the event loop time from which a probe is let through"""
+        return self._retry_at
+
+    def stats(self) -> dict:
+        """Return the state and how often the breaker opened"""
+        return {"state": self._state, "opened": self._opened, "failures": self._failures}
+
+    def register_listener(self, callback: Callable[[str], None]) -> None:
+        """Register callback, called with the new state when the breaker opens or closes."""
+        self._listeners.add(callback)
+
+    def remove_listener(self, callback: Callable[[str], None]) -> None:
+        """Remove previously registered callback."""
+        self._listeners.discard(callback)
+
+    def acquire(self) -> bool:
+        """Return True if the transaction is the probe, raise GatewayUnavailable if it may not run"""
+        if self._state == CLOSED:
+            return False
+        now = asyncio.get_running_loop().time()
+        if self._state == OPEN and now >= self._retry_at:
+            self._state = HALF_OPEN
+            return True
+        raise GatewayUnavailable(f"{self._name}: gateway unavailable, next probe in "
+                                 f"{max(0.0, self._retry_at - now):.1f}s")
+
+    def release(self) -> None:
+        """Give the probe slot back when the probe ended without reaching the gateway"""
+        if self._state == HALF_OPEN:
+            self._state = OPEN
+
+    def succeeded(self) -> None:
+        """Record a transaction the gateway answered"""
+        self._failures = 0
+        if self._state != CLOSED:
+            self._state = CLOSED
+            self._timeout = self._reset_timeout
+            _LOGGER.warning(f"{self._name}: gateway is reachable again")
+            self._notify()
+
+    def failed(self) -> None:
+        """Record a transaction the gateway did not answer"""
+        self._failures += 1
+        if self._state == HALF_OPEN:
+            self._timeout = min(self._timeout * 2, self._max_reset_timeout)
+        elif self._state == OPEN or self._failures < self._failure_threshold:
+            return
+        was_closed = self._state == CLOSED
+        self._state = OPEN
+        self._retry_at = asyncio.get_running_loop().time() + self._timeout
+        if was_closed:
+            self._opened += 1
+            _LOGGER.warning(f"{self._name}: gateway unreachable, failing transactions for {self._timeout:g}s")
+        self._notify()
+
+    def _notify(self) -> None:
+        for callback in list(self._listeners):
+            callback(self._state)
@@ -0,0 +1,185 @@
+"""Scheduler for the transactions sharing one RS485 bus."""
+from __future__ import annotations
+import asyncio
+import itertools
+from typing import Any, Awaitable, Callable, Dict
+from .breaker import CLOSED, CircuitBreaker, GatewayUnavailable
+from .connection import TRANSPORT_ERRORS
+from .const import TIMEOUT
+from .metrics import TransactionMetrics
+
+PRIORITY_WRITE = 0
+PRIORITY_POLL = 10
+# Reads of slowly changing values, run when no write or regular poll is waiting
+PRIORITY_BACKGROUND = 20
+
+
+class WaitStats:
+    """Time transactions of one priority spent in the queue"""
+
+    __slots__ = ("count", "total", "max", "last")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def add(self, wait: float) -> None:
+        """Record the queue wait of one transaction"""
+        self.count += 1
+        self.total += wait
+        self.last = wait
+        if wait > self.max:
+            self.max = wait
+
+    def as_dict(self) -> Dict[str, float]:
+        """Return count, average, maximum and last wait"""
+        return {"count": self.count,
+                "avg": self.total / self.count if self.count else 0.0,
+                "max": self.max,
+                "last": self.last}
+
+
+class _Transaction:
+    __slots__ = ("factory", "priority", "deadline", "enqueued", "future", "probe")
+
+    def __init__(self, factory: Callable[[], Awaitable[Any]], priority: int, deadline: float, enqueued: float,
+                 future: asyncio.Future, probe: bool) -> None:
+        self.factory = factory
+        self.priority = priority
+        self.deadline = deadline
+        self.enqueued = enqueued
+        self.future = future
+        self.probe = probe
+
+
+class BusScheduler:
+    """Runs the transactions of one gateway one at a time, writes ahead of polls"""
+
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self._sequence = itertools.count()
+        self._worker: asyncio.Task | None = None
+        self._stopped = False
+        self._waits = {PRIORITY_WRITE: WaitStats(), PRIORITY_POLL: WaitStats(), PRIORITY_BACKGROUND: WaitStats()}
+        self._expired = 0
+        self._metrics = TransactionMetrics()
+        self._breaker = CircuitBreaker(name)
+
+    @property
+    def queue_depth(self) -> int:
+        """Return the number of transactions waiting for the bus"""
+        return self._queue.qsize()
+
+    @property
+    def metrics(self) -> TransactionMetrics:
+        """Return the outcome counters of the transactions run on the bus"""
+        return self._metrics
+
+    @property
+    def breaker(self) -> CircuitBreaker:
+        """Return the circuit breaker of the gateway"""
+        return self._breaker
+
+    def stats(self) -> Dict[str, Any]:
+        """Return queue depth, wait times and expired transaction counter"""
+        return {"queue_depth": self.queue_depth,
+                "expired": self._expired,
+                "wait_write": self._waits[PRIORITY_WRITE].as_dict(),
+                "wait_poll": self._waits[PRIORITY_POLL].as_dict(),
+                "wait_background": self._waits[PRIORITY_BACKGROUND].as_dict(),
+                "transactions": self._metrics.as_dict(),
+                "breaker": self._breaker.stats()}
+
+    async def run(self, transaction: Callable[[], Awaitable[Any]], priority: int = PRIORITY_POLL,
+                  timeout: float = TIMEOUT) -> Any:
+        """Queue a transaction and return its result once it ran on the bus
+
+        The timeout only bounds the time spent in the queue: a transaction still
+        queued when it passes is dropped without touching the bus. Once running,
+        the exchange is bounded by the adaptive timeout of the connection. While
+        the breaker is open or once the scheduler was stopped, the transaction
+        fails at once with GatewayUnavailable.
+        """
+        if self._stopped:
+            raise GatewayUnavailable(f"{self._name}: bus stopped")
+        probe = self._breaker.acquire()
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._work())
+
+        now = loop.time()
+        job = _Transaction(transaction, priority, now + timeout, now, loop.create_future(), probe)
+        # A running exchange is never aborted: the device would keep answering on the
+        # half-duplex line while the next request goes out. Higher priorities only go first in the queue.
+        self._queue.put_nowait((priority, next(self._sequence), job))
+        return await job.future
+
+    async def async_stop(self) -> None:
+        """Stop the worker and fail the queued transactions and every later one"""
+        self._stopped = True
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        while not self._queue.empty():
+            _, _, job = self._queue.get_nowait()
+            if not job.future.done():
+                job.future.cancel()
+
+    async def _work(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, job = await self._queue.get()
+            if job.future.done():
+                # The caller gave up waiting
+                if job.probe:
+                    self._breaker.release()
+                continue
+
+            now = loop.time()
+            self._waits.get(job.priority, self._waits[PRIORITY_POLL]).add(now - job.enqueued)
+            if now >= job.deadline:
+                self._expired += 1
+                if job.probe:
+                    self._breaker.release()
+                job.future.set_exception(asyncio.TimeoutError(f"{self._name}: transaction expired in the queue"))
+                continue
+            if not job.probe and self._breaker.state != CLOSED:
+                # Queued before the breaker opened
+                job.future.set_exception(GatewayUnavailable(f"{self._name}: gateway unavailable"))
+                continue
+
+            task = loop.create_task(job.factory())
+            try:
+                await asyncio.wait((task,))
+            except asyncio.CancelledError:
+                task.cancel()
+                job.future.cancel()
+                if job.probe:
+                    self._breaker.release()
+                raise
+
+            exc = None if task.cancelled() else task.exception()
+            if task.cancelled():
+                if job.probe:
+                    self._breaker.release()
+            else:
+                self._metrics.record(loop.time() - now, exc)
+                if isinstance(exc, TRANSPORT_ERRORS):
+                    self._breaker.failed()
+                else:
+                    self._breaker.succeeded()
+            if job.future.done():
+                continue
+            if task.cancelled():
+                job.future.cancel()
+            elif exc is not None:
+                job.future.set_exception(exc)
+            else:
+                job.future.set_result(task.result())
@@ -0,0 +1,65 @@
+"""Deadbands deciding which measured values are worth publishing."""
+from __future__ import annotations
+import time
+from typing import Dict
+
+
+class Deadband:
+    """Smallest change of a value that is published"""
+
+    __slots__ = ("absolute", "relative")
+
+    def __init__(self, absolute: float = 0.0, relative: float = 0.0) -> None:
+        self.absolute = absolute
+        self.relative = relative
+
+    def exceeded(self, previous: float, value: float) -> bool:
+        """Return True if value moved past both the absolute and the relative deadband"""
+        delta = abs(value - previous)
+        return delta >= self.absolute and delta >= self.relative * abs(previous)
+
+
+class ChangeFilter:
+    """Per-field change detection with deadbands and a heartbeat"""
+
+    def __init__(self, deadbands: Dict[str, Deadband], max_silence: float) -> None:
+        self._deadbands = deadbands
+        self._max_silence = max_silence
+        self._published: Dict[str, float | None] = {}
+        self._published_at: Dict[str, float] = {}
+        self.published = 0
+        self.suppressed = 0
+
+    def configure(self, deadbands: Dict[str, Deadband], max_silence: float) -> None:
+        """Replace the deadbands and the heartbeat interval"""
+        self._deadbands = deadbands
+        self._max_silence = max_silence
+
+    def reset(self) -> None:
+        """Publish every field on its next value"""
+        self._published.clear()
+        self._published_at.clear()
+
+    def should_publish(self, field: str, value: float | None, now: float | None = None) -> bool:
+        """Return True and remember value if it differs enough from the last published one"""
+        if now is None:
+            now = time.monotonic()
+        previous = self._published.get(field)
+        if field in self._published and now - self._published_at[field] < self._max_silence:
+            if value == previous:
+                self.suppressed += 1
+                return False
+            deadband = self._deadbands.get(field)
+            if value is not None and previous is not None and deadband is not None \
+                    and not deadband.exceeded(previous, value):
+                self.suppressed += 1
+                return False
+
+        self._published[field] = value
+        self._published_at[field] = now
+        self.published += 1
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        """Return publish counters"""
+        return {"published": self.published, "suppressed": self.suppressed}
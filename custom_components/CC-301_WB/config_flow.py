@@ -1,64 +1,270 @@
 """Config flow for Gran-Electro CC-301-old integration."""
 from __future__ import annotations
-from typing import Any
+import asyncio
+import socket
+from typing import Any, List
 import voluptuous as vol
 from homeassistant import config_entries, exceptions
-from .const import DOMAIN
-import platform
-import subprocess
+from homeassistant.core import callback
+from .const import (CONF_COUNTS_OF_COILS, CONF_DEVICE_IDS, CONF_RELAYS, CONF_SLAVE_IDS, CONF_MAX_SILENCE,
+                    CONF_MAX_TIMEOUT, CONF_METER_INTERVAL, CONF_MIN_TIMEOUT, CONF_POWER_DEADBAND,
+                    CONF_RELATIVE_DEADBAND, CONF_SWITCH_INTERVAL, CONF_VOLTAGE_DEADBAND, DEFAULT_MAX_SILENCE,
+                    DEFAULT_MAX_TIMEOUT, DEFAULT_METER_INTERVAL, DEFAULT_MIN_TIMEOUT, DEFAULT_POWER_DEADBAND,
+                    DEFAULT_RELATIVE_DEADBAND, DEFAULT_SWITCH_INTERVAL, DEFAULT_VOLTAGE_DEADBAND, DOMAIN,
+                    MAX_TIMEOUT_LIMIT)
+from .connection import GatewayConnection
+from .discovery import (DEFAULT_REPLY_WAIT, FIRST_ADDRESS, LAST_ADDRESS, SCAN_CONCURRENCY, discover, probe_meter,
+                        probe_relay)
 
+# Deadline of the connect and of every probe while validating the form
+VALIDATE_TIMEOUT = 2
 
-def ping(host) -> bool:
-    """
-    Returns True if host (str) responds to a ping request.
-    Remember that a host may not respond to a ping (ICMP) request even if the host name is valid.
-    """
-    # Option for the number of packets as a function of
-    param = '-n' if platform.system().lower() == 'windows' else '-c'
-    # Building the command. Ex: "ping -c 1 google.com"
-    command = ['ping', param, '1', host]
-    return subprocess.call(command) == 0
+
+# Markers rather than plain keys, so a scan can suggest the values
+DATA_SCHEMA = vol.Schema({vol.Required("device_name"): str,
+                          vol.Required("host"): str,
+                          vol.Required("port"): str,
+                          vol.Required(CONF_DEVICE_IDS): str,
+                          vol.Required(CONF_SLAVE_IDS): str,
+                          vol.Required(CONF_COUNTS_OF_COILS): str})
+
+# A CC-301 address is one byte of the request frame
+MAX_METER_ID = 255
+
+DISCOVERY_SCHEMA = vol.Schema({
+    vol.Required("device_name"): str,
+    vol.Required("host"): str,
+    vol.Required("port"): str,
+    vol.Required("first_address", default=FIRST_ADDRESS): vol.All(vol.Coerce(int), vol.Range(min=0, max=255)),
+    vol.Required("last_address", default=LAST_ADDRESS): vol.All(vol.Coerce(int), vol.Range(min=0, max=255)),
+    vol.Required("concurrency", default=SCAN_CONCURRENCY): vol.All(vol.Coerce(int), vol.Range(min=1, max=16)),
+    # Milliseconds a device gets to start answering
+    vol.Required("reply_wait", default=round(DEFAULT_REPLY_WAIT * 1000)):
+        vol.All(vol.Coerce(int), vol.Range(min=1, max=5000)),
+})
+
+
+def parse_list(value: str) -> List[int]:
+    """Parse a comma separated list of integers"""
+    try:
+        return [int(item) for item in value.split(",") if item.strip()]
+    except ValueError as exc:
+        raise InvalidList from exc
+
+
+def parse_addresses(value: str, lowest: int, highest: int) -> List[int]:
+    """Parse a comma separated list of distinct addresses from lowest to highest"""
+    addresses = parse_list(value)
+    if len(set(addresses)) != len(addresses) or any(not lowest <= address <= highest for address in addresses):
+        raise InvalidList
+    return addresses
 
 
-DATA_SCHEMA = vol.Schema({"device_name": str,
-                          "device_id": str,
-                          "host": str,
-                          "port": str,
-                          "slave_id": int,
-                          "count_of_coils": int})
+def entry_data(user_input: dict) -> dict[str, Any]:
+    """Turn the comma separated device lists of the form into entry data"""
+    device_ids = parse_addresses(user_input[CONF_DEVICE_IDS], 0, MAX_METER_ID)
+    slave_ids = parse_addresses(user_input[CONF_SLAVE_IDS], FIRST_ADDRESS, LAST_ADDRESS)
+    counts = parse_list(user_input[CONF_COUNTS_OF_COILS])
+    if len(counts) == 1:
+        # One count for every module
+        counts *= len(slave_ids)
+    if not device_ids and not slave_ids or len(counts) != len(slave_ids) or any(count < 1 for count in counts):
+        raise InvalidList
+    return {"device_name": user_input["device_name"],
+            "host": user_input["host"],
+            "port": user_input["port"],
+            CONF_DEVICE_IDS: [str(device_id) for device_id in device_ids],
+            CONF_RELAYS: [[slave_id, count] for slave_id, count in zip(slave_ids, counts)]}
 
 
 async def validate_input(data: dict) -> dict[str, Any]:
-    """ Raise InvalidHost exception if ping failed"""
-    if not ping(data["host"]):
-        raise InvalidHost
-    return {"title": f'CC-301&WB {data["host"]}'}
+    """Connect to the gateway and check that every configured device answers
+
+    Raise InvalidHost if the host does not resolve, CannotConnect if the port
+    does not accept the connection and NoResponse naming the fields whose
+    devices stay silent.
+    """
+    connection = GatewayConnection(data["host"], data["port"])
+    connection.set_timeout_bounds(VALIDATE_TIMEOUT, VALIDATE_TIMEOUT)
+    try:
+        try:
+            connect_time = await connection.connect(VALIDATE_TIMEOUT)
+        except ConnectionError as exc:
+            if isinstance(exc.__cause__, socket.gaierror):
+                raise InvalidHost from exc
+            raise CannotConnect from exc
+
+        # The meters and the relay modules are read over separate sockets, so both kinds run at once
+        meters = [probe_meter(connection, int(device_id)) for device_id in data[CONF_DEVICE_IDS]]
+        relays = [probe_relay(connection, slave_id) for slave_id, _ in data[CONF_RELAYS]]
+        results = await asyncio.gather(*meters, *relays, return_exceptions=True)
+    finally:
+        await connection.async_close()
+
+    fields = []
+    if any(isinstance(result, Exception) for result in results[:len(meters)]):
+        fields.append(CONF_DEVICE_IDS)
+    if any(isinstance(result, Exception) for result in results[len(meters):]):
+        fields.append(CONF_SLAVE_IDS)
+    if fields:
+        raise NoResponse(fields)
+    return {"title": f'CC-301&WB {data["host"]}',
+            "connect": f"{connect_time * 1000:.0f}",
+            "rtt": f"{max(results) * 1000:.0f}"}
 
 
 class ConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
-    VERSION = 1
+    VERSION = 2
     # This tells HA if it should be asking for updates, or it'll be notified of updates
     # automatically. This connection class uses PUSH, as the hub will notify HA of changes.
     CONNECTION_CLASS = config_entries.CONN_CLASS_LOCAL_PUSH
 
+    def __init__(self) -> None:
+        self._discovered: dict[str, Any] = {}
+        self._scan_input: dict[str, Any] = {}
+        self._scan_errors: dict[str, str] = {}
+        self._scan: asyncio.Task | None = None
+
     async def async_step_user(self, user_input=None):
-        """Handle the initial step."""
+        """Let the user choose between scanning the gateway and listing the devices."""
+        return self.async_show_menu(step_id="user", menu_options=["discover", "manual"])
+
+    async def async_step_discover(self, user_input=None):
+        """Ask which addresses to scan, showing why the last scan failed."""
+        errors, self._scan_errors = self._scan_errors, {}
+        if user_input is not None:
+            if user_input["first_address"] > user_input["last_address"]:
+                errors["base"] = "invalid_range"
+            else:
+                self._scan_input = user_input
+                return await self.async_step_scan()
+
+        schema = DISCOVERY_SCHEMA
+        if self._scan_input:
+            schema = self.add_suggested_values_to_schema(DISCOVERY_SCHEMA, self._scan_input)
+        return self.async_show_form(step_id="discover", data_schema=schema, errors=errors)
+
+    async def async_step_scan(self, user_input=None):
+        """Show progress while the gateway is scanned, then prefill the device lists with what answered."""
+        if self._scan is None:
+            self._scan = self.hass.async_create_task(self._async_scan())
+            return self.async_show_progress(step_id="scan", progress_action="scan")
+        self._scan = None
+        return self.async_show_progress_done(next_step_id="discover" if self._scan_errors else "manual")
+
+    async def _async_scan(self) -> None:
+        """Scan the addresses of the discover step, then move the flow on"""
+        user_input = self._scan_input
+        try:
+            found = await discover(user_input["host"], user_input["port"],
+                                   range(user_input["first_address"], user_input["last_address"] + 1),
+                                   user_input["concurrency"], user_input["reply_wait"] / 1000)
+        except ConnectionError:
+            self._scan_errors = {"base": "cannot_connect"}
+        except Exception:
+            self._scan_errors = {"base": "unknown"}
+        else:
+            if not found.device_ids and not found.relays:
+                self._scan_errors = {"base": "nothing_found"}
+            else:
+                self._discovered = {
+                    "device_name": user_input["device_name"],
+                    "host": user_input["host"],
+                    "port": user_input["port"],
+                    CONF_DEVICE_IDS: ",".join(str(device_id) for device_id in found.device_ids),
+                    CONF_SLAVE_IDS: ",".join(str(slave_id) for slave_id, _ in found.relays),
+                    CONF_COUNTS_OF_COILS: ",".join(str(count) for _, count in found.relays)}
+        self.hass.async_create_task(self.hass.config_entries.flow.async_configure(flow_id=self.flow_id))
+
+    @callback
+    def async_remove(self) -> None:
+        """Stop a running scan when the flow is closed"""
+        if self._scan is not None:
+            self._scan.cancel()
+
+    async def async_step_manual(self, user_input=None):
+        """Handle the device lists, typed in or prefilled by a scan."""
 
         errors = {}
         if user_input is not None:
             try:
-                title = await validate_input(user_input)
+                data = entry_data(user_input)
+            except InvalidList:
+                data = None
+                errors["base"] = "invalid_list"
 
-                return self.async_create_entry(title=title["title"], data=user_input)
+        if user_input is not None and data is not None:
+            # One entry per gateway, its meters and relay modules share the bus
+            await self.async_set_unique_id(f'{data["host"].lower()}:{data["port"]}')
+            self._abort_if_unique_id_configured()
+            # Device and entity ids carry the host only, so another port of the gateway would collide with them
+            if any(entry.data["host"].lower() == data["host"].lower() for entry in self._async_current_entries()):
+                errors["host"] = "host_configured"
+                data = None
+
+        if user_input is not None and data is not None:
+            try:
+                info = await validate_input(data)
+
+                return self.async_create_entry(title=info["title"], data=data,
+                                               description_placeholders={"connect": info["connect"],
+                                                                         "rtt": info["rtt"]})
             except InvalidHost:
                 errors["host"] = "invalid_host"
+            except CannotConnect:
+                errors["base"] = "cannot_connect"
+            except NoResponse as exc:
+                for field in exc.fields:
+                    errors[field] = "no_response"
             except Exception:
                 errors["base"] = "unknown"
 
+        schema = DATA_SCHEMA
+        if self._discovered:
+            schema = self.add_suggested_values_to_schema(DATA_SCHEMA, user_input or self._discovered)
         return self.async_show_form(
-            step_id="user", data_schema=DATA_SCHEMA, errors=errors
+            step_id="manual", data_schema=schema, errors=errors
         )
 
+    @staticmethod
+    @callback
+    def async_get_options_flow(config_entry: config_entries.ConfigEntry) -> OptionsFlow:
+        """Return the options flow"""
+        return OptionsFlow(config_entry)
+
+
+class OptionsFlow(config_entries.OptionsFlow):
+    """Poll intervals and publishing deadbands, applied without reloading the entry"""
+
+    def __init__(self, config_entry: config_entries.ConfigEntry) -> None:
+        self.config_entry = config_entry
+
+    async def async_step_init(self, user_input=None):
+        """Manage the options."""
+        if user_input is not None:
+            return self.async_create_entry(title="", data=user_input)
+
+        options = self.config_entry.options
+        schema = vol.Schema({
+            vol.Required(CONF_METER_INTERVAL, default=options.get(CONF_METER_INTERVAL, DEFAULT_METER_INTERVAL)):
+                vol.All(vol.Coerce(float), vol.Range(min=0.5, max=3600)),
+            vol.Required(CONF_SWITCH_INTERVAL, default=options.get(CONF_SWITCH_INTERVAL, DEFAULT_SWITCH_INTERVAL)):
+                vol.All(vol.Coerce(float), vol.Range(min=0.5, max=3600)),
+            vol.Required(CONF_POWER_DEADBAND, default=options.get(CONF_POWER_DEADBAND, DEFAULT_POWER_DEADBAND)):
+                vol.All(vol.Coerce(float), vol.Range(min=0)),
+            vol.Required(CONF_VOLTAGE_DEADBAND, default=options.get(CONF_VOLTAGE_DEADBAND, DEFAULT_VOLTAGE_DEADBAND)):
+                vol.All(vol.Coerce(float), vol.Range(min=0)),
+            vol.Required(CONF_RELATIVE_DEADBAND, default=options.get(CONF_RELATIVE_DEADBAND, DEFAULT_RELATIVE_DEADBAND)):
+                vol.All(vol.Coerce(float), vol.Range(min=0, max=100)),
+            vol.Required(CONF_MAX_SILENCE, default=options.get(CONF_MAX_SILENCE, DEFAULT_MAX_SILENCE)):
+                vol.All(vol.Coerce(float), vol.Range(min=1)),
+            vol.Required(CONF_MIN_TIMEOUT, default=options.get(CONF_MIN_TIMEOUT, DEFAULT_MIN_TIMEOUT)):
+                vol.All(vol.Coerce(float), vol.Range(min=0.01, max=10)),
+            vol.Required(CONF_MAX_TIMEOUT, default=options.get(CONF_MAX_TIMEOUT, DEFAULT_MAX_TIMEOUT)):
+                vol.All(vol.Coerce(float), vol.Range(min=0.1, max=MAX_TIMEOUT_LIMIT)),
+        })
+        return self.async_show_form(step_id="init", data_schema=schema)
+
 
 class CannotConnect(exceptions.HomeAssistantError):
     """Error to indicate we cannot connect."""
@@ -66,3 +272,15 @@ class CannotConnect(exceptions.HomeAssistantError):
 
 class InvalidHost(exceptions.HomeAssistantError):
     """Error to indicate there is an invalid hostname."""
+
+
+class NoResponse(exceptions.HomeAssistantError):
+    """Error to indicate configured devices did not answer."""
+
+    def __init__(self, fields: List[str]) -> None:
+        super().__init__(f"No response from the devices of {', '.join(fields)}")
+        self.fields = fields
+
+
+class InvalidList(exceptions.HomeAssistantError):
+    """Error to indicate a device address list cannot be parsed."""
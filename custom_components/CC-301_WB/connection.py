@@ -0,0 +1,329 @@
+"""Long-lived connections to TCP-to-RS485 gateways."""
+from __future__ import annotations
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Tuple
+from pymodbus.client import AsyncModbusTcpClient
+from pymodbus.exceptions import ConnectionException, ModbusIOException
+from pymodbus.framer import ModbusRtuFramer
+from .assembler import FrameAssembler
+from .const import DEFAULT_MAX_TIMEOUT, DEFAULT_MIN_TIMEOUT, MAX_TIMEOUT_LIMIT
+from .rtt import RttEstimator
+
+_LOGGER = logging.getLogger(__name__)
+
+BACKOFF_MIN = 0.5
+BACKOFF_MAX = 30
+# Doublings of the backoff counted at most, far past BACKOFF_MAX but short of a float overflow
+MAX_DOUBLINGS = 16
+MAX_IDLE = 60
+# Time a released connection stays open, so a reloading entry takes over its sockets
+LINGER = 10
+READ_SIZE = 256
+# Timeout pymodbus applies inside every request, above any the options allow, so only the adaptive one counts
+CLIENT_TIMEOUT = 2 * MAX_TIMEOUT_LIMIT
+# Leading request bytes a CC-301 response repeats: address, function and parameter
+HEADER_SIZE = 3
+
+# Failures that mean the gateway did not answer, as opposed to a device error response
+TRANSPORT_ERRORS = (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError, ConnectionException,
+                    ModbusIOException)
+
+
+class TransactionError(Exception):
+    """Error to indicate the device answered with an error response"""
+
+
+class GatewayConnection:
+    """Long-lived sockets to one gateway, shared by the electric meter and the modbus switcher"""
+
+    def __init__(self, host: str, port: str) -> None:
+        self._host = host
+        self._port = int(port)
+        self._min_timeout = DEFAULT_MIN_TIMEOUT
+        self._max_timeout = DEFAULT_MAX_TIMEOUT
+        self._rtt: Dict[str, RttEstimator] = {}
+        # Retries and reconnects are paced by the connection itself, not by pymodbus;
+        # the adaptive timeouts are applied around its requests
+        self._client = AsyncModbusTcpClient(host, port=self._port, framer=ModbusRtuFramer,
+                                            timeout=CLIENT_TIMEOUT, retries=0, reconnect_delay=0)
+        self._client_lock = asyncio.Lock()
+        self._stream_lock = asyncio.Lock()
+        self._assembler = FrameAssembler()
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._stream_last_used = 0.0
+        self._stream_lost = False
+        self._client_last_used = 0.0
+        self._client_lost = False
+        self._users = 0
+        self._close_handle: asyncio.TimerHandle | None = None
+        self._failures = 0
+        self._retry_at = 0.0
+        self._opened = 0
+        self._reused = 0
+        self._reconnects = 0
+
+    @property
+    def key(self) -> Tuple[str, int]:
+        """Return the (host, port) the connection is registered under"""
+        return self._host, self._port
+
+    @property
+    def opened(self) -> int:
+        """Return how many sockets were opened"""
+        return self._opened
+
+    @property
+    def reused(self) -> int:
+        """Return how many transactions reused an open socket"""
+        return self._reused
+
+    @property
+    def reconnects(self) -> int:
+        """Return how many times a dropped or stale socket was replaced"""
+        return self._reconnects
+
+    def stats(self) -> Dict[str, Any]:
+        """Return connection counters and the timeout of every kind of transaction"""
+        return {"opened": self._opened, "reused": self._reused, "reconnects": self._reconnects,
+                **self._assembler.stats(),
+                "timeouts": {kind: estimator.as_dict() for kind, estimator in self._rtt.items()}}
+
+    def set_timeout_bounds(self, min_timeout: float, max_timeout: float) -> None:
+        """Clamp the adaptive timeouts to [min_timeout, max_timeout]"""
+        self._min_timeout = min_timeout
+        self._max_timeout = max(min_timeout, max_timeout)
+        for estimator in self._rtt.values():
+            estimator.set_bounds(self._min_timeout, self._max_timeout)
+
+    def timeout(self, kind: str) -> float:
+        """Return the current timeout of a kind of transaction"""
+        return self._estimator(kind).timeout
+
+    def _estimator(self, kind: str) -> RttEstimator:
+        estimator = self._rtt.get(kind)
+        if estimator is None:
+            estimator = self._rtt[kind] = RttEstimator(self._min_timeout, self._max_timeout)
+        return estimator
+
+    async def connect(self, timeout: float) -> float:
+        """Open the raw socket if it is not open yet, return the seconds it took"""
+        started = time.monotonic()
+        async with self._stream_lock:
+            await self._ensure_stream(timeout)
+        return time.monotonic() - started
+
+    async def transact(self, request: bytes, response_length: int, timeout: float | None = None) -> bytes:
+        """Send a raw request over the event loop and return the response_length bytes answering it
+
+        The response is assembled from whatever arrives, skipping stale or
+        garbled bytes in front of it. Without an explicit timeout, the one
+        estimated from earlier answers of the same length is used.
+        """
+        estimator = self._estimator(f"transact_{response_length}")
+        if timeout is None:
+            timeout = estimator.timeout
+        async with self._stream_lock:
+            reader, writer = await self._ensure_stream(self._max_timeout)
+            started = time.monotonic()
+            try:
+                # Whatever is left over can only belong to an earlier exchange
+                self._assembler.clear()
+                writer.write(request)
+                await asyncio.wait_for(writer.drain(), timeout)
+                response = await asyncio.wait_for(self._receive(reader, request[:HEADER_SIZE], response_length),
+                                                  timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError, asyncio.IncompleteReadError, OSError) as exc:
+                partial = self._assembler.partial(request[:HEADER_SIZE])
+                # A late reply to the same request could not be told apart from the next answer, so start over
+                self._drop_stream()
+                if isinstance(exc, asyncio.TimeoutError):
+                    estimator.timed_out()
+                    if partial:
+                        raise asyncio.IncompleteReadError(partial, response_length) from exc
+                raise
+            finally:
+                self._stream_last_used = time.monotonic()
+            estimator.sample(self._stream_last_used - started)
+            return response
+
+    async def _receive(self, reader: asyncio.StreamReader, header: bytes, response_length: int) -> bytes:
+        while True:
+            frame = self._assembler.next_frame(header, response_length)
+            if frame is not None:
+                return frame
+            data = await reader.read(READ_SIZE)
+            if not data:
+                raise asyncio.IncompleteReadError(self._assembler.partial(header), response_length)
+            self._assembler.feed(data)
+
+    async def probe(self, request: bytes, response_length: int, first_byte_timeout: float, timeout: float) -> bool:
+        """Send a raw request and return True if the addressed device starts answering in first_byte_timeout
+
+        Only the start of an answer is waited for, so a silent address costs
+        little, and silence leaves the socket open for the next probe. An
+        answer is read up to response_length bytes or timeout, so its tail
+        cannot be taken for the next one. CC-301 and Modbus answers alike
+        start with the address and the function, with the error bit for a
+        Modbus error response.
+        """
+        headers = (request[:2], bytes((request[0], request[1] | 0x80)))
+        async with self._stream_lock:
+            reader, writer = await self._ensure_stream(self._max_timeout)
+            received = bytearray()
+            try:
+                writer.write(request)
+                await asyncio.wait_for(writer.drain(), first_byte_timeout)
+                received += await asyncio.wait_for(reader.read(READ_SIZE), first_byte_timeout)
+                if not received:
+                    raise asyncio.IncompleteReadError(b"", response_length)
+                deadline = time.monotonic() + timeout
+                while len(received) < response_length:
+                    data = await asyncio.wait_for(reader.read(READ_SIZE), max(0.0, deadline - time.monotonic()))
+                    if not data:
+                        raise asyncio.IncompleteReadError(bytes(received), response_length)
+                    received += data
+            except asyncio.TimeoutError:
+                if not received:
+                    return False
+            except (asyncio.CancelledError, asyncio.IncompleteReadError, OSError):
+                self._drop_stream()
+                raise
+            finally:
+                self._stream_last_used = time.monotonic()
+            return any(header in received for header in headers)
+
+    async def call(self, method: str, *args: Any, timeout: float | None = None, **kwargs: Any) -> Any:
+        """Await a pymodbus client request and return its response
+
+        Without an explicit timeout, the one estimated from earlier answers to
+        the same method is used.
+        """
+        estimator = self._estimator(method)
+        if timeout is None:
+            timeout = estimator.timeout
+        async with self._client_lock:
+            await self._ensure_client(self._max_timeout)
+            started = time.monotonic()
+            try:
+                response = await asyncio.wait_for(getattr(self._client, method)(*args, **kwargs), timeout)
+            except (Exception, asyncio.CancelledError) as exc:
+                self._drop_client()
+                if isinstance(exc, asyncio.TimeoutError):
+                    estimator.timed_out()
+                raise
+            finally:
+                self._client_last_used = time.monotonic()
+            estimator.sample(self._client_last_used - started)
+            if response.isError():
+                raise TransactionError(f"Modbus {method} failed: {response}")
+            return response
+
+    async def async_close(self) -> None:
+        """Close the sockets"""
+        self._drop_stream()
+        self._client.close()
+
+    async def _ensure_stream(self, timeout: float) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        if self._writer is not None:
+            if not (self._reader.at_eof() or self._writer.is_closing()
+                    or time.monotonic() - self._stream_last_used > MAX_IDLE):
+                self._reused += 1
+                return self._reader, self._writer
+            self._drop_stream()
+
+        self._check_backoff()
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self._host, self._port), timeout)
+        except (asyncio.TimeoutError, OSError) as exc:
+            self._connect_failed()
+            raise ConnectionError(f"Cannot connect to gateway {self._host}:{self._port}") from exc
+
+        self._connected(self._stream_lost)
+        self._stream_lost = False
+        return self._reader, self._writer
+
+    def _drop_stream(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._stream_lost = True
+        self._reader = self._writer = None
+        self._assembler.reset()
+
+    async def _ensure_client(self, timeout: float) -> None:
+        if self._client.connected:
+            if time.monotonic() - self._client_last_used <= MAX_IDLE:
+                self._reused += 1
+                return
+            self._drop_client()
+
+        self._check_backoff()
+        try:
+            connected = await asyncio.wait_for(self._client.connect(), timeout)
+        except asyncio.TimeoutError:
+            connected = False
+        if not connected:
+            self._client.close()
+            self._connect_failed()
+            raise ConnectionError(f"Cannot connect to gateway {self._host}:{self._port}")
+
+        self._connected(self._client_lost)
+        self._client_lost = False
+
+    def _drop_client(self) -> None:
+        self._client.close()
+        self._client_lost = True
+
+    def _check_backoff(self) -> None:
+        now = time.monotonic()
+        if now < self._retry_at:
+            raise ConnectionError(f"Gateway {self._host}:{self._port} is backing off for {self._retry_at - now:.1f}s")
+
+    def _connect_failed(self) -> None:
+        self._failures += 1
+        self._retry_at = time.monotonic() + min(BACKOFF_MAX, BACKOFF_MIN * 2 ** min(self._failures - 1, MAX_DOUBLINGS))
+
+    def _connected(self, replaced: bool) -> None:
+        self._failures = 0
+        self._opened += 1
+        if replaced:
+            self._reconnects += 1
+
+
+_CONNECTIONS: Dict[Tuple[str, int], GatewayConnection] = {}
+
+
+def acquire_connection(host: str, port: str) -> GatewayConnection:
+    """Return the shared connection to a gateway, the lingering one if it was just released"""
+    key = (host, int(port))
+    connection = _CONNECTIONS.get(key)
+    if connection is None:
+        connection = _CONNECTIONS[key] = GatewayConnection(host, port)
+    if connection._close_handle is not None:
+        connection._close_handle.cancel()
+        connection._close_handle = None
+    connection._users += 1
+    return connection
+
+
+async def release_connection(connection: GatewayConnection, linger: float = LINGER) -> None:
+    """Close the connection once its last user released it and nobody took it over for linger seconds"""
+    connection._users -= 1
+    if connection._users > 0:
+        return
+    if linger <= 0:
+        await _close(connection)
+        return
+    loop = asyncio.get_running_loop()
+    connection._close_handle = loop.call_later(linger, lambda: loop.create_task(_close(connection)))
+
+
+async def _close(connection: GatewayConnection) -> None:
+    connection._close_handle = None
+    if connection._users <= 0:
+        if _CONNECTIONS.get(connection.key) is connection:
+            del _CONNECTIONS[connection.key]
+        await connection.async_close()
@@ -3,3 +3,40 @@
 DOMAIN = "CC-301_WB"
 SCAN_INTERVAL = 3
 TIMEOUT = 3
+
+# Addresses of the CC-301 meters and (slave id, count of coils) of the WB-MR modules behind the gateway
+CONF_DEVICE_IDS = "device_ids"
+CONF_RELAYS = "relays"
+# Comma separated lists in the config flow form
+CONF_SLAVE_IDS = "slave_ids"
+CONF_COUNTS_OF_COILS = "counts_of_coils"
+
+CONF_METER_INTERVAL = "meter_interval"
+CONF_SWITCH_INTERVAL = "switch_interval"
+DEFAULT_METER_INTERVAL = SCAN_INTERVAL
+DEFAULT_SWITCH_INTERVAL = SCAN_INTERVAL
+
+# Bounds of the timeouts adapted to the measured round trip time
+CONF_MIN_TIMEOUT = "min_timeout"
+CONF_MAX_TIMEOUT = "max_timeout"
+DEFAULT_MIN_TIMEOUT = 0.05
+DEFAULT_MAX_TIMEOUT = TIMEOUT
+# Largest maximum timeout the options accept
+MAX_TIMEOUT_LIMIT = 30
+
+CONF_POWER_DEADBAND = "power_deadband"
+CONF_VOLTAGE_DEADBAND = "voltage_deadband"
+CONF_RELATIVE_DEADBAND = "relative_deadband"
+CONF_MAX_SILENCE = "max_silence"
+DEFAULT_POWER_DEADBAND = 1.0
+DEFAULT_VOLTAGE_DEADBAND = 0.5
+DEFAULT_RELATIVE_DEADBAND = 0.0
+DEFAULT_MAX_SILENCE = 300
+
+# Change of the summary power, in W, that makes the meter poll faster for a while
+LARGE_POWER_CHANGE = 500
+
+# Coil changes requested within this many seconds are written in one frame
+WRITE_COALESCE_WINDOW = 0.02
+
+SERVICE_SET_COILS = "set_coils"
@@ -0,0 +1,17 @@
+"""Diagnostics support for the CC-301_WB integration."""
+from __future__ import annotations
+from typing import Any
+from homeassistant.components.diagnostics import async_redact_data
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant
+from .const import DOMAIN
+
+# The title and the unique id of an entry carry the host too
+TO_REDACT = {"host", "title", "unique_id"}
+
+
+async def async_get_config_entry_diagnostics(hass: HomeAssistant, entry: ConfigEntry) -> dict[str, Any]:
+    """Return the transaction statistics and the device states of a hub"""
+    hub = hass.data[DOMAIN][entry.entry_id]
+    return {"entry": async_redact_data(entry.as_dict(), TO_REDACT),
+            "hub": hub.diagnostics()}
@@ -0,0 +1,156 @@
+"""Probing and discovery of the meters and relay modules behind a gateway."""
+from __future__ import annotations
+import asyncio
+import logging
+import time
+from typing import Callable, Iterable, List, NamedTuple, Tuple
+from .connection import GatewayConnection, TransactionError, TRANSPORT_ERRORS
+from .crc16 import check_crc, crc16_bytes
+from .frames import CRC_BYTEORDER, INSTANT_VALUES, INSTANT_VALUES_RESPONSE_LENGTH, REQUEST_FRAMES
+
+_LOGGER = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT = 2
+# Slowest bus speed a probe has to allow for, 10 bits on the line per byte
+BAUDRATE = 9600
+# Time a device gets to start answering once the request is on the line, for its turnaround and the gateway
+DEFAULT_REPLY_WAIT = 0.03
+REQUEST_LENGTH = 8
+READ_COILS = 1
+READ_COILS_RESPONSE_LENGTH = 6
+MODBUS_CRC_BYTEORDER = "little"
+# Sockets probing at once; more only help gateways that queue their clients
+SCAN_CONCURRENCY = 1
+MAX_COILS = 128
+FIRST_ADDRESS = 1
+LAST_ADDRESS = 247
+
+
+def line_time(*lengths: int, baudrate: int = BAUDRATE) -> float:
+    """Return the seconds the frames of the given lengths take on the bus"""
+    return sum(lengths) * 10 / baudrate
+
+
+COUNT_TIMEOUT = line_time(REQUEST_LENGTH, READ_COILS_RESPONSE_LENGTH) + DEFAULT_REPLY_WAIT
+
+
+def read_coils_request(slave_id: int) -> bytes:
+    """Build the Modbus RTU frame reading the first coil of a relay module"""
+    payload = bytes((slave_id, READ_COILS, 0, 0, 0, 1))
+    return payload + crc16_bytes(payload, MODBUS_CRC_BYTEORDER)
+
+
+class Discovery(NamedTuple):
+    """Devices that answered a scan"""
+
+    device_ids: List[int]
+    relays: List[Tuple[int, int]]
+
+
+async def probe_meter(connection: GatewayConnection, device_id: int, timeout: float | None = None) -> float:
+    """Read the instant values of a meter once, return the round trip time"""
+    started = time.monotonic()
+    response = await connection.transact(REQUEST_FRAMES.get(device_id, INSTANT_VALUES),
+                                         INSTANT_VALUES_RESPONSE_LENGTH, timeout)
+    if response[3] != 0 or not check_crc(response, CRC_BYTEORDER):
+        raise TransactionError(f"Electric meter {device_id} gave an invalid response")
+    return time.monotonic() - started
+
+
+async def probe_relay(connection: GatewayConnection, slave_id: int, timeout: float | None = None) -> float:
+    """Read the first coil of a relay module once, return the round trip time"""
+    started = time.monotonic()
+    await connection.call("read_coils", 0, 1, slave=slave_id, timeout=timeout)
+    return time.monotonic() - started
+
+
+async def count_coils(connection: GatewayConnection, slave_id: int, timeout: float = COUNT_TIMEOUT,
+                      max_coils: int = MAX_COILS) -> int:
+    """Return the number of coils of a relay module
+
+    The module refuses to read a coil past its last one, so the count is the
+    first refused address, found by bisection.
+    """
+    low, high = 0, max_coils
+    while low < high:
+        middle = (low + high) // 2
+        try:
+            await connection.call("read_coils", middle, 1, slave=slave_id, timeout=timeout)
+        except TransactionError:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
+class _Kind(NamedTuple):
+    """How to probe one kind of device in a sweep"""
+
+    request: Callable[[int], bytes]
+    response_length: int
+
+
+METER = _Kind(lambda device_id: REQUEST_FRAMES.get(device_id, INSTANT_VALUES), INSTANT_VALUES_RESPONSE_LENGTH)
+RELAY = _Kind(read_coils_request, READ_COILS_RESPONSE_LENGTH)
+
+
+async def _sweep(connections: List[GatewayConnection], addresses: Iterable[int], kind: _Kind,
+                 first_byte_timeout: float, timeout: float) -> List[int]:
+    pending = iter(addresses)
+    found: List[int] = []
+
+    async def worker(connection: GatewayConnection) -> None:
+        # The workers share one iterator, so every address is probed once
+        for address in pending:
+            try:
+                answered = await connection.probe(kind.request(address), kind.response_length, first_byte_timeout,
+                                                  timeout)
+            except ConnectionError:
+                raise
+            except TRANSPORT_ERRORS:
+                answered = False
+            if answered:
+                found.append(address)
+
+    await asyncio.gather(*(worker(connection) for connection in connections))
+    return sorted(found)
+
+
+async def discover(host: str, port: str, addresses: Iterable[int] = range(FIRST_ADDRESS, LAST_ADDRESS + 1),
+                   concurrency: int = SCAN_CONCURRENCY, reply_wait: float = DEFAULT_REPLY_WAIT) -> Discovery:
+    """Scan the addresses for meters and relay modules and count the coils of the modules
+
+    Meters are swept first and relay modules after them, as both share one
+    half-duplex line. A silent address costs the time its request takes on
+    the line, reply_wait and the round trip the connect took; a device that
+    starts answering gets the time its whole answer takes on top. Raise
+    ConnectionError if the gateway cannot be reached.
+    """
+    addresses = list(addresses)
+    connections = [GatewayConnection(host, port) for _ in range(max(1, concurrency))]
+    started = time.monotonic()
+    try:
+        # The connect took about one round trip to the gateway
+        wait = reply_wait + await connections[0].connect(CONNECT_TIMEOUT)
+        first_byte_timeout = line_time(REQUEST_LENGTH + 1) + wait
+        device_ids = await _sweep(connections, addresses, METER, first_byte_timeout,
+                                  line_time(INSTANT_VALUES_RESPONSE_LENGTH) + wait)
+        # An address answered by a meter cannot belong to a relay module on the same line
+        slave_ids = await _sweep(connections, [address for address in addresses if address not in device_ids],
+                                 RELAY, first_byte_timeout, line_time(READ_COILS_RESPONSE_LENGTH) + wait)
+        relays = []
+        for slave_id in slave_ids:
+            try:
+                count = await count_coils(connections[0], slave_id,
+                                          line_time(REQUEST_LENGTH, READ_COILS_RESPONSE_LENGTH) + wait)
+            except TRANSPORT_ERRORS as exc:
+                _LOGGER.warning(f"Relay module {slave_id} stopped answering while counting its coils: {exc!r}")
+                continue
+            if count:
+                relays.append((slave_id, count))
+    finally:
+        for connection in connections:
+            await connection.async_close()
+    _LOGGER.info(f"Scanned {len(addresses)} addresses of {host}:{port} in {time.monotonic() - started:.1f}s, "
+                 f"found meters {device_ids} and relay modules {relays}")
+    return Discovery(device_ids, relays)
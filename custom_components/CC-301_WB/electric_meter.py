@@ -1,10 +1,13 @@
+from __future__ import annotations
 import logging
-import struct
-import threading
-from typing import List
-import serial
-from subprocess import run
-from .const import TIMEOUT
+from functools import partial
+from typing import Dict, Tuple
+from .breaker import GatewayUnavailable
+from .bus import BusScheduler, PRIORITY_BACKGROUND, PRIORITY_POLL
+from .connection import GatewayConnection, TransactionError, TRANSPORT_ERRORS
+from .crc16 import check_crc
+from .frames import CRC_BYTEORDER, REQUEST_FRAMES
+from .registers import BLOCKS, POLL_FAST, REGISTERS, RegisterBlock
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -12,132 +15,84 @@ _LOGGER = logging.getLogger(__name__)
 class ElectricMeter:
     """Electric Meter Gran Electro CC-301"""
 
-    def __init__(self, device_id: str, host: str, port: str, mutex: threading.Lock) -> None:
-        self._host = host
-        self._port = port
+    FIELDS = tuple(register.name for register in REGISTERS)
+
+    def __init__(self, device_id: str, connection: GatewayConnection, bus: BusScheduler) -> None:
+        self._connection = connection
         self._available = False
-        self._summary_power = None
-        self._first_phase_power = None
-        self._second_phase_power = None
-        self._third_phase_power = None
-        self._first_phase_voltage = None
-        self._second_phase_voltage = None
-        self._third_phase_voltage = None
-        self._response_length = 78
+        self._values: Dict[str, float | None] = dict.fromkeys(self.FIELDS)
         self._device_id = device_id
-        self._command = f"{device_id} 3 46 0 0 0"
+        self._requests = {block.command: REQUEST_FRAMES.get(int(device_id), block.command) for block in BLOCKS}
         self._rounding_accuracy = 2
-        self._mutex = mutex
-
-    def summary_power(self) -> float:
-        return self._summary_power
-
-    def first_phase_power(self) -> float:
-        return self._first_phase_power
-
-    def second_phase_power(self) -> float:
-        return self._second_phase_power
-
-    def third_phase_power(self) -> float:
-        return self._third_phase_power
+        self._bus = bus
 
-    def first_phase_voltage(self) -> float:
-        return self._first_phase_voltage
-
-    def second_phase_voltage(self) -> float:
-        return self._second_phase_voltage
-
-    def third_phase_voltage(self) -> float:
-        return self._third_phase_voltage
+    def value(self, field: str) -> float | None:
+        """Return the last value of a register map field"""
+        return self._values[field]
 
     @property
     def available(self) -> bool:
         """Return True if electric meter and hub is available"""
         return self._available
 
-    def prepare_command(self) -> bytearray:
-        """Calculating and adding crc"""
-        numbers = []
-        for el in self._command.split(" "):
-            numbers.append(int(el))
-
-        command_line = ""
-        packet = bytearray()
-
-        for num in numbers:
-            packet.append(num)
-            command_line += str(num) + " "
-
-        result = run(f"'./custom_components/CC-301_WB/CRC' {command_line}", shell=True, capture_output=True)
-        result = result.stdout.decode()
-        packet.append(int("0x" + result[5:7], 16))
-        packet.append(int("0x" + result[3:5], 16))
+    def set_unavailable(self) -> None:
+        """Mark the values stale until the next successful read"""
+        self._available = False
 
-        return packet
+    def prepare_command(self, block: RegisterBlock) -> bytes:
+        """Return the request frame with crc"""
+        return self._requests[block.command]
 
-    def get_data(self, packet) -> bytes:
+    async def get_data(self, packet, response_length: int, priority: int = PRIORITY_POLL) -> bytes:
         """Sends a request and receive a response"""
-        ser = serial.serial_for_url(f"socket://{self._host}:{self._port}", timeout=TIMEOUT)
-
-        try:
-            ser.write(packet)
-            response = ser.read(self._response_length)
-        finally:
-            ser.close()
-
-        return response
+        return await self._bus.run(partial(self._connection.transact, packet, response_length), priority)
 
     @staticmethod
-    def unpack_data(line) -> List:
-        """Сonverting response from hex to float"""
-        unpacked_data = []
-        index = 0
-        while index + 4 < 78:
-            unpacked_data.append(struct.unpack('f', line[index:index + 4])[0])
-            index += 4
-        return unpacked_data
+    def unpack_data(block: RegisterBlock, line) -> Tuple[Tuple[str, float], ...]:
+        """Decode the mapped floats straight from the response buffer"""
+        return block.decode(line)
 
     @staticmethod
     def check_crc(response) -> bool:
         """Check crc from response"""
-        command_line = ""
-
-        for num in response[:76]:
-            command_line += str(num) + " "
-
-        result = run(f"'./custom_components/CC-301_WB/CRC' {command_line}", shell=True, capture_output=True)
-        result = result.stdout.decode()
-
-        first_crc_response_byte = "0x" + result[5:7]
-        second_crc_response_byte = "0x" + result[3:5]
-        first_crc_check_byte = hex(response[76])
-        second_crc_check_byte = hex(response[77])
-
-        return first_crc_response_byte == first_crc_check_byte and second_crc_response_byte == second_crc_check_byte
+        return check_crc(response, CRC_BYTEORDER)
 
     @staticmethod
     def check_response(response) -> bool:
         """Check success byte"""
         return response[3] == 0
 
-    def update(self) -> None:
-        """Update electric meter state"""
+    async def update(self, poll_class: str = POLL_FAST) -> bool:
+        """Read the blocks of one poll class, return True if any value changed"""
+        previous = self.values()
         try:
-            prepared_command = self.prepare_command()
-            response = self.get_data(prepared_command)
-
-            if self.check_response(response) and self.check_crc(response):
-                unpacked_data = self.unpack_data(response)
-
-                self._summary_power = round(50 * unpacked_data[1], self._rounding_accuracy)
-                self._first_phase_power = round(50 * unpacked_data[2], self._rounding_accuracy)
-                self._second_phase_power = round(50 * unpacked_data[3], self._rounding_accuracy)
-                self._third_phase_power = round(50 * unpacked_data[4], self._rounding_accuracy)
-                self._first_phase_voltage = round(unpacked_data[9], self._rounding_accuracy)
-                self._second_phase_voltage = round(unpacked_data[10], self._rounding_accuracy)
-                self._third_phase_voltage = round(unpacked_data[11], self._rounding_accuracy)
-                self._available = True
-        except Exception as exc:
-            _LOGGER.error(exc)
-            # self._available = False
-
+            for block in BLOCKS:
+                if block.poll_class == poll_class:
+                    await self.update_block(block)
+        except TRANSPORT_ERRORS + (GatewayUnavailable,):
+            # An error response or a bad crc still shows the meter is reachable
+            if poll_class == POLL_FAST:
+                self._available = False
+            raise
+        if poll_class == POLL_FAST:
+            self._available = True
+        return self.values() != previous
+
+    async def update_block(self, block: RegisterBlock) -> None:
+        """Read one command and store the values of its registers"""
+        # Only the fast values go ahead of the other devices, the rest must not delay them
+        priority = PRIORITY_POLL if block.poll_class == POLL_FAST else PRIORITY_BACKGROUND
+        response = await self.get_data(self.prepare_command(block), block.response_length, priority)
+
+        if not self.check_response(response):
+            raise TransactionError("Electric meter answered with an error status")
+        if not self.check_crc(response):
+            self._bus.metrics.crc_failed()
+            raise TransactionError("Electric meter response has a wrong crc")
+
+        for name, value in self.unpack_data(block, response):
+            self._values[name] = round(value, self._rounding_accuracy)
+
+    def values(self) -> Dict[str, float | None]:
+        """Return a copy of all measured values by field"""
+        return dict(self._values)
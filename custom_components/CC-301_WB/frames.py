@@ -0,0 +1,55 @@
+"""Request frames for the CC-301 exchange."""
+from __future__ import annotations
+from typing import Dict, Tuple
+from .crc16 import crc16_bytes
+
+# CC-301 transmits the CRC high byte first, unlike Modbus RTU
+CRC_BYTEORDER = "big"
+
+# Function 3, parameter 46: instantaneous power and voltage
+INSTANT_VALUES = (3, 46, 0, 0, 0)
+INSTANT_VALUES_RESPONSE_LENGTH = 78
+
+# Full response length of every command, header and crc included
+RESPONSE_LENGTHS: Dict[Tuple[int, ...], int] = {
+    INSTANT_VALUES: INSTANT_VALUES_RESPONSE_LENGTH,
+}
+
+
+def build_request(device_id: int, command: Tuple[int, ...]) -> bytes:
+    """Build a request frame with crc"""
+    packet = bytearray((device_id, *command))
+    packet += crc16_bytes(packet, CRC_BYTEORDER)
+    return bytes(packet)
+
+
+class RequestFrameCache:
+    """Keeps each (device_id, command) request frame built once"""
+
+    def __init__(self, max_size: int = 64) -> None:
+        self._max_size = max_size
+        self._frames: Dict[Tuple[int, Tuple[int, ...]], bytes] = {}
+
+    def get(self, device_id: int, command: Tuple[int, ...]) -> bytes:
+        """Return the cached frame, building it on first use"""
+        key = (device_id, command)
+        frame = self._frames.get(key)
+        if frame is None:
+            if len(self._frames) >= self._max_size:
+                del self._frames[next(iter(self._frames))]
+            frame = self._frames[key] = build_request(device_id, command)
+        return frame
+
+    def invalidate(self, device_id: int | None = None) -> None:
+        """Drop the frames of one device, or all of them"""
+        if device_id is None:
+            self._frames.clear()
+            return
+        for key in [key for key in self._frames if key[0] == device_id]:
+            del self._frames[key]
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+
+REQUEST_FRAMES = RequestFrameCache()
@@ -2,78 +2,249 @@
 from __future__ import annotations
 import asyncio
 import logging
-import threading
-from typing import List, Callable
+from functools import partial
+from typing import Any, Callable, Dict, List, Mapping, Sequence, Set, Tuple
 from homeassistant.core import HomeAssistant
+from .breaker import CLOSED, OPEN
+from .bus import BusScheduler
+from .change_filter import ChangeFilter, Deadband
+from .connection import GatewayConnection, acquire_connection, release_connection
 from .electric_meter import ElectricMeter
-from .const import SCAN_INTERVAL, TIMEOUT
+from .registers import POLL_CLASSES, POLL_FAST, REGISTERS
+from .const import (CONF_MAX_SILENCE, CONF_MAX_TIMEOUT, CONF_METER_INTERVAL, CONF_MIN_TIMEOUT, CONF_POWER_DEADBAND,
+                    CONF_RELATIVE_DEADBAND, CONF_SWITCH_INTERVAL, CONF_VOLTAGE_DEADBAND, DEFAULT_MAX_SILENCE,
+                    DEFAULT_MAX_TIMEOUT, DEFAULT_METER_INTERVAL, DEFAULT_MIN_TIMEOUT, DEFAULT_POWER_DEADBAND,
+                    DEFAULT_RELATIVE_DEADBAND, DEFAULT_SWITCH_INTERVAL, DEFAULT_VOLTAGE_DEADBAND, DOMAIN,
+                    LARGE_POWER_CHANGE)
 from .modbus_switcher import ModbusSwitcher
+from .polling import BURST, CHANGED, UNCHANGED, PollScheduler
 
 _LOGGER = logging.getLogger(__name__)
 
+# Option and default interval of every meter poll class
+POLL_CLASS_INTERVALS = {
+    POLL_FAST: (CONF_METER_INTERVAL, DEFAULT_METER_INTERVAL),
+}
+
+# Pause before the poll scheduler is restarted after an unexpected error
+RESTART_DELAY = 5
+
+
 class Hub:
+    """Gateway with any number of electric meters and relay modules sharing one bus"""
 
-    def __init__(self, hass: HomeAssistant, device_name: str, device_id: str, host: str, port: str, slave_id: int, count_of_coils: int) -> None:
-        self._mutex = threading.Lock()
+    def __init__(self, hass: HomeAssistant, device_name: str, host: str, port: str, device_ids: Sequence[str],
+                 relays: Sequence[Tuple[int, int]], options: Mapping[str, Any]) -> None:
         self._hass = hass
         self._name = f'{device_name}_{host}'
         self._id = host.lower()
-        self.devices = [
-            Meter(f"electric_meter_{self._id}",
-                   f"{device_name}",
-                  device_id,
-                  host,
-                  port,
-                  self._mutex),
-
-            ModbusDevice(f"modbus_switcher_{self._id}",
-                         f"{device_name}",
-                         slave_id,
-                         host,
-                         port,
-                         count_of_coils,
-                         self._mutex),
-        ]
+        self._connection = acquire_connection(host, port)
+        self._connection.set_timeout_bounds(options.get(CONF_MIN_TIMEOUT, DEFAULT_MIN_TIMEOUT),
+                                            options.get(CONF_MAX_TIMEOUT, DEFAULT_MAX_TIMEOUT))
+        self._bus = BusScheduler(self._name)
+        self.meters = [Meter(f"electric_meter_{self._id}_{device_id}",
+                             device_name if len(device_ids) == 1 else f"{device_name} {device_id}",
+                             device_id,
+                             self._connection,
+                             self._bus)
+                       for device_id in device_ids]
+        self.relays = [ModbusDevice(f"modbus_switcher_{self._id}_{slave_id}",
+                                    device_name if len(relays) == 1 else f"{device_name} {slave_id}",
+                                    slave_id,
+                                    self._connection,
+                                    count_of_coils,
+                                    self._bus)
+                       for slave_id, count_of_coils in relays]
+        self.devices = [*self.meters, *self.relays]
         self.online = True
+        self._poller = PollScheduler()
+        # A device is only polled while an entity listens to it, so the polls start as the entities are added
+        for meter in self.meters:
+            targets = [meter.poll_target(poll_class) for poll_class in POLL_CLASSES]
+            for poll_class, target in zip(POLL_CLASSES, targets):
+                option, default = POLL_CLASS_INTERVALS[poll_class]
+                self._poller.add(target, partial(meter.update, poll_class), options.get(option, default),
+                                 paused=not meter.listened)
+            meter.register_listening_callback(partial(self._set_listening, targets))
+            meter.configure_publishing(options)
+        for switcher in self.relays:
+            self._poller.add(switcher.id, switcher.update, options.get(CONF_SWITCH_INTERVAL, DEFAULT_SWITCH_INTERVAL),
+                             paused=not switcher.listened)
+            switcher.register_listening_callback(partial(self._set_listening, [switcher.id]))
+            # Toggles in a burst are confirmed by one read after it
+            switcher.modbus_switcher.register_write_callback(partial(self._poller.boost, switcher.id))
+        self._bus.breaker.register_listener(self._breaker_changed)
+        self._probe_handle: asyncio.TimerHandle | None = None
+        self._probes: Set[asyncio.Task] = set()
         self._loop = asyncio.get_event_loop()
-        self._loop.create_task(self.update())
-
+        # The only task polling the devices, it lives exactly as long as the hub
+        self._poll_task: asyncio.Task | None = self._loop.create_task(self._run_polls())
 
     @property
     def device_info(self):
         """Return information to link this entity with the correct device."""
-        return {"model": "CC-301 and modbus switcher"}
+        return {"identifiers": {(DOMAIN, f"gateway_{self._id}")},
+                "name": self._name,
+                "model": "CC-301 and modbus switcher"}
 
     @property
     def hub_id(self) -> str:
         """Return hub id."""
         return self._id
 
-    async def update(self):
+    @property
+    def connection(self) -> GatewayConnection:
+        """Return the connection shared by the hub devices"""
+        return self._connection
+
+    @property
+    def bus(self) -> BusScheduler:
+        """Return the scheduler of the gateway bus"""
+        return self._bus
+
+    @property
+    def poller(self) -> PollScheduler:
+        """Return the scheduler of the device polls"""
+        return self._poller
+
+    def relay(self, slave_id: int | None = None) -> ModbusDevice | None:
+        """Return the relay module with the slave id, or the first one"""
+        for switcher in self.relays:
+            if slave_id is None or switcher.slave_id == slave_id:
+                return switcher
+        return None
+
+    def diagnostic_values(self) -> Dict[str, Any]:
+        """Return the transaction figures shown by the diagnostic sensors"""
+        metrics = self._bus.metrics
+        rtt_average = metrics.rtt_average
+        rtt_p99 = metrics.rtt_percentile(0.99)
+        return {"transactions": metrics.transactions,
+                "rtt_average": None if rtt_average is None else round(rtt_average * 1000, 1),
+                "rtt_p99": None if rtt_p99 is None else rtt_p99 * 1000,
+                "timeouts": metrics.timeouts,
+                "crc_failures": metrics.crc_failures,
+                "short_reads": metrics.short_reads,
+                "errors": metrics.errors,
+                "reconnects": self._connection.reconnects,
+                "queue_wait": round(self._bus.stats()["wait_poll"]["avg"] * 1000, 1),
+                "queue_depth": self._bus.queue_depth}
+
+    def diagnostics(self) -> Dict[str, Any]:
+        """Return the state of the bus, the connection and the polls for a diagnostics download
+
+        Devices are named without the host, so the download does not reveal it.
+        """
+        return {"bus": self._bus.stats(),
+                "connection": self._connection.stats(),
+                "polls": {self._without_host(name): {"interval": target.interval, "failures": target.failures,
+                                                     "paused": target.paused}
+                          for name, target in self._poller.targets.items()},
+                "meters": {self._without_host(meter.id): {"available": meter.electric_meter.available,
+                                                          "publishing": meter.change_filter.stats()}
+                           for meter in self.meters},
+                "relays": {self._without_host(switcher.id): {"available": switcher.modbus_switcher.available,
+                                                             "states": switcher.modbus_switcher.states}
+                           for switcher in self.relays}}
+
+    def _without_host(self, name: str) -> str:
+        return name.replace(f"_{self._id}_", "_")
+
+    def apply_options(self, options: Mapping[str, Any]) -> None:
+        """Change poll intervals, timeouts and deadbands without restarting the hub"""
+        self._connection.set_timeout_bounds(options.get(CONF_MIN_TIMEOUT, DEFAULT_MIN_TIMEOUT),
+                                            options.get(CONF_MAX_TIMEOUT, DEFAULT_MAX_TIMEOUT))
+        for meter in self.meters:
+            for poll_class in POLL_CLASSES:
+                option, default = POLL_CLASS_INTERVALS[poll_class]
+                self._poller.set_interval(meter.poll_target(poll_class), options.get(option, default))
+            meter.configure_publishing(options)
+        for switcher in self.relays:
+            self._poller.set_interval(switcher.id, options.get(CONF_SWITCH_INTERVAL, DEFAULT_SWITCH_INTERVAL))
+
+    def _set_listening(self, targets: List[str], listening: bool) -> None:
+        for target in targets:
+            self._poller.set_paused(target, not listening)
+
+    def _breaker_changed(self, state: str) -> None:
+        if state == OPEN:
+            # Show stale values as unavailable at once and probe when the breaker allows it
+            for meter in self.meters:
+                meter.set_unavailable()
+            for switcher in self.relays:
+                switcher.modbus_switcher.set_unavailable()
+            if self._probe_handle is not None:
+                self._probe_handle.cancel()
+            self._probe_handle = self._loop.call_at(self._bus.breaker.retry_at, self._start_probe)
+        elif state == CLOSED:
+            for name in self._poller.targets:
+                self._poller.boost(name)
+
+    def _start_probe(self) -> None:
+        self._probe_handle = None
+        task = self._loop.create_task(self._probe())
+        self._probes.add(task)
+        task.add_done_callback(self._probes.discard)
+
+    async def _probe(self) -> None:
+        """Run one cheap transaction; the breaker closes if it succeeds"""
+        try:
+            if self.relays:
+                switcher = self.relays[0]
+                await self._bus.run(partial(self._connection.call, "read_coils", 0, 1, slave=switcher.slave_id))
+            else:
+                await self.meters[0].electric_meter.update()
+        except Exception as exc:
+            _LOGGER.debug(f"{self._name}: probe failed: {exc}")
+
+    @property
+    def polling(self) -> bool:
+        """Return True while the poll task runs"""
+        return self._poll_task is not None and not self._poll_task.done()
+
+    async def _run_polls(self) -> None:
+        """Poll the devices until the hub closes, restarting the scheduler if it fails"""
         while True:
-            await asyncio.sleep(SCAN_INTERVAL)
-            for device in self.devices:
-                try:
-                    self._mutex.acquire(timeout=TIMEOUT)
-                    await device.update()
-                    self._mutex.release()
-                except Exception as exc:
-                    _LOGGER.error(exc)
+            try:
+                await self._poller.run()
+            except Exception:
+                _LOGGER.exception(f"{self._name}: poll scheduler failed, restarting in {RESTART_DELAY}s")
+                await asyncio.sleep(RESTART_DELAY)
+
+    async def async_close(self) -> None:
+        """Stop polling and the bus scheduler and release the gateway connection"""
+        self._bus.breaker.remove_listener(self._breaker_changed)
+        if self._probe_handle is not None:
+            self._probe_handle.cancel()
+            self._probe_handle = None
+        tasks = [*self._probes]
+        if self._poll_task is not None:
+            tasks.append(self._poll_task)
+            self._poll_task = None
+        for task in tasks:
+            task.cancel()
+        # Wait for the polls to finish cancelling, so none of them reopens the connection
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # A coalesced write would otherwise still go out once its window passed
+        for switcher in self.relays:
+            await switcher.modbus_switcher.async_close()
+        await self._bus.async_stop()
+        await release_connection(self._connection)
 
 
 class Meter:
     """Device responsible for electric meter"""
 
-    def __init__(self, hass_device_id: str, name: str, device_id: str, host: str, port: str, mutex: threading.Lock) -> None:
-        self._mutex = mutex
+    def __init__(self, hass_device_id: str, name: str, device_id: str, connection: GatewayConnection, bus: BusScheduler) -> None:
         self._id = hass_device_id
         self._name = name
-        self._electric_meter = ElectricMeter(device_id, host, port, mutex)
+        self._electric_meter = ElectricMeter(device_id, connection, bus)
         self._model = "CC-301"
         self._manufacturer = "Gran Electro"
-        self._callbacks = set()
-        self._loop = asyncio.get_event_loop()
-        self._loop.create_task(self.update())
+        self._callbacks: Dict[str, Set[Callable[[], None]]] = {}
+        self._listening_callbacks: Set[Callable[[bool], None]] = set()
+        self._change_filter = ChangeFilter({}, DEFAULT_MAX_SILENCE)
+        self._published_available = None
 
     @property
     def model(self) -> str:
@@ -100,40 +271,105 @@ class Meter:
         """Returns the object receiving and storing the state of electric meter"""
         return self._electric_meter
 
-    def register_callback(self, callback: Callable[[], None]) -> None:
-        """Register callback, called when electric meter changes state."""
-        self._callbacks.add(callback)
+    @property
+    def change_filter(self) -> ChangeFilter:
+        """Return the filter counting published and suppressed writes"""
+        return self._change_filter
 
-    def remove_callback(self, callback: Callable[[], None]) -> None:
-        """Remove previously registered callback."""
-        self._callbacks.discard(callback)
+    @property
+    def polled(self) -> bool:
+        """Return True once a poll result was published"""
+        return self._published_available is not None
+
+    def configure_publishing(self, options: Mapping[str, Any]) -> None:
+        """Set the deadbands and the heartbeat from the entry options"""
+        power = options.get(CONF_POWER_DEADBAND, DEFAULT_POWER_DEADBAND)
+        voltage = options.get(CONF_VOLTAGE_DEADBAND, DEFAULT_VOLTAGE_DEADBAND)
+        relative = options.get(CONF_RELATIVE_DEADBAND, DEFAULT_RELATIVE_DEADBAND) / 100
+        absolute = {"power": power, "voltage": voltage}
+        deadbands = {register.name: Deadband(absolute.get(register.device_class, 0.0), relative)
+                     for register in REGISTERS}
+        self._change_filter.configure(deadbands, options.get(CONF_MAX_SILENCE, DEFAULT_MAX_SILENCE))
+
+    def poll_target(self, poll_class: str) -> str:
+        """Return the poll scheduler name of a poll class"""
+        return self._id if poll_class == POLL_FAST else f"{self._id}_{poll_class}"
 
-    def publish_updates(self) -> None:
-        """Schedule call all registered callbacks."""
-        for callback in self._callbacks:
-            callback()
+    @property
+    def listened(self) -> bool:
+        """Return True while an entity listens to the electric meter"""
+        return any(self._callbacks.values())
+
+    def register_listening_callback(self, callback: Callable[[bool], None]) -> None:
+        """Register callback, called with True when the first entity listens and False when the last one left."""
+        self._listening_callbacks.add(callback)
 
-    async def update(self) -> None:
-        """Update electric meter sensors states"""
-        await self._loop.run_in_executor(None, self._electric_meter.update)
+    def register_callback(self, callback: Callable[[], None], field: str) -> None:
+        """Register callback, called when the field of electric meter changes."""
+        listened = self.listened
+        self._callbacks.setdefault(field, set()).add(callback)
+        self._listening_changed(listened)
+
+    def remove_callback(self, callback: Callable[[], None], field: str) -> None:
+        """Remove previously registered callback."""
+        listened = self.listened
+        self._callbacks.get(field, set()).discard(callback)
+        self._listening_changed(listened)
+
+    def _listening_changed(self, listened: bool) -> None:
+        if self.listened != listened:
+            for callback in self._listening_callbacks:
+                callback(not listened)
+
+    def set_unavailable(self) -> None:
+        """Mark the electric meter sensors unavailable"""
+        self._electric_meter.set_unavailable()
         self.publish_updates()
 
+    def publish_updates(self) -> None:
+        """Call the callbacks of the fields that changed past their deadband."""
+        available = self._electric_meter.available
+        if available != self._published_available:
+            # Availability changes reach every sensor
+            self._published_available = available
+            self._change_filter.reset()
+        for field, value in self._electric_meter.values().items():
+            callbacks = self._callbacks.get(field)
+            if callbacks and self._change_filter.should_publish(field, value):
+                for callback in callbacks:
+                    callback()
+
+    async def update(self, poll_class: str = POLL_FAST) -> int:
+        """Update the electric meter sensors of one poll class"""
+        previous_power = self._electric_meter.value("summary_power")
+        try:
+            changed = await self._electric_meter.update(poll_class)
+        finally:
+            self.publish_updates()
+        if not changed:
+            return UNCHANGED
+        if poll_class != POLL_FAST:
+            return CHANGED
+        power = self._electric_meter.value("summary_power")
+        if previous_power is not None and abs(power - previous_power) >= LARGE_POWER_CHANGE:
+            return BURST
+        return CHANGED
+
 
 class ModbusDevice:
 
-    def __init__(self, hass_device_id: str, name: str, slave_id: int, host: str, port: str, count_of_coils: int, mutex: threading.Lock) -> None:
-        self._mutex = mutex
+    def __init__(self, hass_device_id: str, name: str, slave_id: int, connection: GatewayConnection, count_of_coils: int, bus: BusScheduler) -> None:
         self._id = hass_device_id
-        self._host = host
-        self._port = port
         self._slave_id = slave_id
         self._count_of_coils = count_of_coils
         self._name = name
-        self._modbus_switcher = ModbusSwitcher(slave_id, host, port, count_of_coils, mutex)
+        self._modbus_switcher = ModbusSwitcher(slave_id, connection, count_of_coils, bus)
         self._model = "WB-MR"
         self._manufacturer = "Wirenboard"
         self._switches = []
-        self._callbacks = set()
+        self._callbacks: Dict[int, Set[Callable[[], None]]] = {}
+        self._listening_callbacks: Set[Callable[[bool], None]] = set()
+        self._modbus_switcher.register_state_callback(self.publish_updates)
 
     @property
     def model(self) -> str:
@@ -160,6 +396,11 @@ class ModbusDevice:
         """Returns the device id"""
         return self._id
 
+    @property
+    def slave_id(self) -> int:
+        """Returns the modbus address of the relay module"""
+        return self._slave_id
+
     @property
     def switches(self) -> List:
         """Return list of modbus switches"""
@@ -170,21 +411,45 @@ class ModbusDevice:
         """Returns the count of device coils """
         return self._count_of_coils
 
-    def register_callback(self, callback: Callable[[], None]) -> None:
-        """Register callback, called when modbus switches changes state."""
-        self._callbacks.add(callback)
+    @property
+    def listened(self) -> bool:
+        """Return True while an entity listens to the relay module"""
+        return any(self._callbacks.values())
 
-    def remove_callback(self, callback: Callable[[], None]) -> None:
-        """Remove previously registered callback."""
-        self._callbacks.discard(callback)
+    def register_listening_callback(self, callback: Callable[[bool], None]) -> None:
+        """Register callback, called with True when the first entity listens and False when the last one left."""
+        self._listening_callbacks.add(callback)
 
-    def publish_updates(self) -> None:
-        """Schedule call all registered callbacks."""
-        for callback in self._callbacks:
-            callback()
+    def register_callback(self, callback: Callable[[], None], coil: int) -> None:
+        """Register callback, called when the coil changes state."""
+        listened = self.listened
+        self._callbacks.setdefault(coil, set()).add(callback)
+        self._listening_changed(listened)
 
-    async def update(self) -> None:
+    def remove_callback(self, callback: Callable[[], None], coil: int) -> None:
+        """Remove previously registered callback."""
+        listened = self.listened
+        self._callbacks.get(coil, set()).discard(callback)
+        self._listening_changed(listened)
+
+    def _listening_changed(self, listened: bool) -> None:
+        if self.listened != listened:
+            for callback in self._listening_callbacks:
+                callback(not listened)
+
+    def publish_updates(self, changed: int) -> None:
+        """Call the callbacks of the coils set in the changed bitmask."""
+        while changed:
+            low_bit = changed & -changed
+            for callback in self._callbacks.get(low_bit.bit_length() - 1, ()):
+                callback()
+            changed ^= low_bit
+
+    async def set_coils(self, states: int, mask: int) -> None:
+        """Switch the coils selected by mask"""
+        await self._modbus_switcher.set_coils(states, mask)
+
+    async def update(self) -> int:
         """Update modbus switches states"""
-        self._modbus_switcher.update()
-        for light in self._switches:
-            light.async_schedule_update_ha_state(True)
\ No newline at end of file
+        changed = await self._modbus_switcher.update()
+        return CHANGED if changed else UNCHANGED
\ No newline at end of file
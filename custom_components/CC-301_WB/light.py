@@ -3,21 +3,26 @@ from __future__ import annotations
 from typing import Any
 from .const import DOMAIN
 from homeassistant.components.light import (LightEntity)
+from homeassistant.const import STATE_OFF, STATE_ON
+from homeassistant.core import callback
+from homeassistant.helpers.restore_state import RestoreEntity
     
 async def async_setup_entry(hass, config_entry, async_add_entities):
     """Add sensors for passed config_entry in HA."""
     hub = hass.data[DOMAIN][config_entry.entry_id]
-    device = hub.devices[1]
-    for i in range(device.count_of_coils):
-        light = ModbusSwitch(device, i, f"_{str(i)}")
-        device.switches.append(light)
-    if device:
-        async_add_entities(device.switches)
+    new_devices = []
+    for device in hub.relays:
+        for i in range(device.count_of_coils):
+            light = ModbusSwitch(device, i, f"_{str(i)}")
+            device.switches.append(light)
+        new_devices.extend(device.switches)
+    if new_devices:
+        async_add_entities(new_devices)
 
 
-class ModbusSwitch(LightEntity):
+class ModbusSwitch(LightEntity, RestoreEntity):
 
-    should_poll = True
+    should_poll = False
 
     @property
     def device_info(self):
@@ -33,42 +38,55 @@ class ModbusSwitch(LightEntity):
 
     def __init__(self, device, coil: int, name="") -> None:
         self._switcher = device.modbus_switcher
-        self._state = None
         self._device = device
-        self._attr_unique_id = f"{self._device.name}_{name}"
+        self._attr_unique_id = f"{self._device.id}_{coil}"
         self._attr_name = f"{self._device.name}_{name}"
         self._coil = coil
+        # State from before the restart, shown until the first read confirms or fails
+        self._restored: bool | None = None
 
     @property
     def is_on(self) -> bool | None:
         """Return true if light is on."""
-        return self._state
+        if self._restored is not None:
+            return self._restored
+        return self._switcher.is_on(self._coil)
 
-    def turn_on(self, **kwargs: Any) -> None:
+    @property
+    def extra_state_attributes(self):
+        """Flag a restored state that no read confirmed yet."""
+        return {"stale": True} if self._restored is not None else None
+
+    async def async_turn_on(self, **kwargs: Any) -> None:
         """Instruct the light to turn on."""
-        self._switcher.turn_on(self._coil)
-        self._state = True
+        await self._switcher.turn_on(self._coil)
 
-    def turn_off(self, **kwargs: Any) -> None:
+    async def async_turn_off(self, **kwargs: Any) -> None:
         """Instruct the light to turn off."""
-        self._switcher.turn_off(self._coil)
-        self._state = False
-
-    def update(self) -> None:
-        self._state = self._switcher.is_on(self._coil)
+        await self._switcher.turn_off(self._coil)
 
     @property
     def available(self) -> bool:
         """Return True if roller and hub is available"""
-        return self._switcher.available
+        return self._restored is not None or self._switcher.available
 
     async def async_added_to_hass(self) -> None:
         """Run when this Entity has been added to HA."""
+        if not self._switcher.polled:
+            last = await self.async_get_last_state()
+            if last is not None and last.state in (STATE_ON, STATE_OFF):
+                self._restored = last.state == STATE_ON
         # Sensors should also register callbacks to HA when their state changes
-        self._device.register_callback(self.async_write_ha_state)
+        self._device.register_callback(self._handle_update, self._coil)
 
     async def async_will_remove_from_hass(self) -> None:
         """Entity being removed from hass."""
         # The opposite of async_added_to_hass. Remove any registered call backs here.
-        self._device.remove_callback(self.async_write_ha_state)
+        self._device.remove_callback(self._handle_update, self._coil)
+
+    @callback
+    def _handle_update(self) -> None:
+        """Drop the restored state once the coil was read, written or went unavailable."""
+        self._restored = None
+        self.async_write_ha_state()
 
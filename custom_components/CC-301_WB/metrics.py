@@ -0,0 +1,72 @@
+"""Outcome counters and round trip times of the transactions of one gateway."""
+from __future__ import annotations
+import asyncio
+from bisect import bisect_left
+from typing import Any, Dict, List
+
+# Upper bounds of the round trip time histogram buckets, in seconds; the last bucket is unbounded
+RTT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class TransactionMetrics:
+    """Counts every bus transaction by outcome, cheap enough to stay on"""
+
+    def __init__(self) -> None:
+        self.histogram: List[int] = [0] * (len(RTT_BUCKETS) + 1)
+        self.transactions = 0
+        self.succeeded = 0
+        self.timeouts = 0
+        self.short_reads = 0
+        self.crc_failures = 0
+        self.errors = 0
+        self.rtt_total = 0.0
+        self.rtt_last = 0.0
+
+    def record(self, rtt: float, exc: BaseException | None = None) -> None:
+        """Count a finished transaction, its round trip time only if it succeeded"""
+        self.transactions += 1
+        if exc is None:
+            self.succeeded += 1
+            self.rtt_total += rtt
+            self.rtt_last = rtt
+            self.histogram[bisect_left(RTT_BUCKETS, rtt)] += 1
+        elif isinstance(exc, asyncio.IncompleteReadError):
+            self.short_reads += 1
+        elif isinstance(exc, asyncio.TimeoutError):
+            self.timeouts += 1
+        else:
+            self.errors += 1
+
+    def crc_failed(self) -> None:
+        """Count a response that arrived complete but with a wrong crc"""
+        self.crc_failures += 1
+
+    @property
+    def rtt_average(self) -> float | None:
+        """Return the mean round trip time of the successful transactions"""
+        return self.rtt_total / self.succeeded if self.succeeded else None
+
+    def rtt_percentile(self, fraction: float) -> float | None:
+        """Return the upper bound of the bucket holding the percentile, None beyond the last bound"""
+        if not self.succeeded:
+            return None
+        rank = fraction * self.succeeded
+        seen = 0
+        for bound, count in zip(RTT_BUCKETS, self.histogram):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Return the counters and the histogram keyed by bucket bound in ms"""
+        labels = [f"<={bound * 1000:g}ms" for bound in RTT_BUCKETS] + [f">{RTT_BUCKETS[-1] * 1000:g}ms"]
+        return {"transactions": self.transactions,
+                "succeeded": self.succeeded,
+                "timeouts": self.timeouts,
+                "short_reads": self.short_reads,
+                "crc_failures": self.crc_failures,
+                "errors": self.errors,
+                "rtt_average": self.rtt_average,
+                "rtt_last": self.rtt_last,
+                "rtt_histogram": dict(zip(labels, self.histogram))}
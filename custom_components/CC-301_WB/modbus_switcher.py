@@ -1,80 +1,206 @@
+import asyncio
 import logging
-import threading
+from functools import partial
+from typing import Callable, Dict, List, Tuple
 
 
-from pymodbus.client import ModbusTcpClient
-from pymodbus.framer import ModbusRtuFramer
-from .const import TIMEOUT
+from .breaker import GatewayUnavailable
+from .bus import BusScheduler, PRIORITY_POLL, PRIORITY_WRITE
+from .connection import GatewayConnection, TRANSPORT_ERRORS
+from .const import WRITE_COALESCE_WINDOW
 
 
 _LOGGER = logging.getLogger(__name__)
 
 class ModbusSwitcher:
 
-    def __init__(self, slave_id: int, host: str, port: str, count_of_coils: int, mutex: threading.Lock):
-        self._host = host
-        self._port = port
+    def __init__(self, slave_id: int, connection: GatewayConnection, count_of_coils: int, bus: BusScheduler):
+        self._connection = connection
         self._slave_id = slave_id
-        self._states = []
-        self._client = None
         self._count_of_coils = count_of_coils
-        self._available = False
-        self._mutex = mutex
-
-        for i in range(self._count_of_coils):
-            self._states.append(None)
+        self._all_coils = (1 << count_of_coils) - 1
+        # Coil states as a bitmask, bit n is coil n; _known marks the coils read or written at least once
+        self._states = 0
+        self._known = 0
+        # None until the first read succeeded or failed
+        self._available: bool | None = None
+        self._bus = bus
+        self._pending: Dict[int, Tuple[bool, List[asyncio.Future]]] = {}
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._writes = set()
+        self._write_callbacks = set()
+        self._state_callbacks = set()
 
     @property
     def available(self) -> bool:
         """Return True if switcher and hub is available"""
-        return self._available
+        return bool(self._available)
 
-    def is_on(self, coil: int) -> bool | None:
-        """Return true if light is on."""
-        return self._states[coil]
+    @property
+    def polled(self) -> bool:
+        """Return True once a read of the coils succeeded or failed"""
+        return self._available is not None
 
-    def turn_on(self, coil: int) -> None:
-        self._mutex.acquire(timeout=TIMEOUT)
-        self.connect()
-        self._client.write_coil(coil, True, slave=self._slave_id)
-        self.disconnect()
-        self._mutex.release()
+    @property
+    def states(self) -> int:
+        """Return the coil states as a bitmask"""
+        return self._states
 
-        self._states[coil] = True
+    def is_on(self, coil: int) -> bool | None:
+        """Return true if light is on."""
+        if not self._known >> coil & 1:
+            return None
+        return bool(self._states >> coil & 1)
+
+    def register_state_callback(self, callback: Callable[[int], None]) -> None:
+        """Register callback, called with the bitmask of the coils whose state changed."""
+        self._state_callbacks.add(callback)
+
+    def remove_state_callback(self, callback: Callable[[int], None]) -> None:
+        """Remove previously registered callback."""
+        self._state_callbacks.discard(callback)
+
+    def _set_states(self, states: int, mask: int) -> int:
+        """Store the states of the coils in mask and return the bitmask of the coils that flipped"""
+        flipped = ((self._states ^ states) | ~self._known) & mask
+        self._states = (self._states & ~mask) | (states & mask)
+        self._known |= mask
+        if flipped:
+            for callback in self._state_callbacks:
+                callback(flipped)
+        return flipped
+
+    def set_unavailable(self) -> None:
+        """Mark the coil states stale until the next successful read"""
+        self._set_available(False)
+
+    def _set_available(self, available: bool) -> None:
+        if available != self._available:
+            self._available = available
+            for callback in self._state_callbacks:
+                callback(self._all_coils)
+
+    def register_write_callback(self, callback: Callable[[], None]) -> None:
+        """Register callback, called after coils were written."""
+        self._write_callbacks.add(callback)
+
+    def remove_write_callback(self, callback: Callable[[], None]) -> None:
+        """Remove previously registered callback."""
+        self._write_callbacks.discard(callback)
+
+    async def turn_on(self, coil: int) -> None:
+        await self.set_coil(coil, True)
         _LOGGER.warning(f"Switch {coil} on")
 
-    def turn_off(self, coil: int) -> None:
-        self._mutex.acquire(timeout=TIMEOUT)
-        self.connect()
-        self._client.write_coil(coil, False, slave=self._slave_id)
-        self.disconnect()
-        self._mutex.release()
-
-        self._states[coil] = False
+    async def turn_off(self, coil: int) -> None:
+        await self.set_coil(coil, False)
         _LOGGER.warning(f"Switch {coil} off")
 
-    def connect(self) -> None:
+    async def set_coil(self, coil: int, value: bool) -> None:
+        """Queue a coil change; changes made within a short window go out as one frame"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        _, futures = self._pending.get(coil, (value, []))
+        futures.append(future)
+        self._pending[coil] = (value, futures)
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(WRITE_COALESCE_WINDOW, self._flush)
+        await future
+
+    async def set_coils(self, states: int, mask: int) -> None:
+        """Set every coil selected by mask to its bit in states"""
+        await asyncio.gather(*(self.set_coil(coil, bool(states >> coil & 1))
+                               for coil in range(self._count_of_coils) if mask >> coil & 1))
+
+    def _flush(self) -> None:
+        self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        for run in self._coil_runs(sorted(pending)):
+            task = asyncio.get_running_loop().create_task(self._write_run(run, pending))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    def _coil_runs(self, coils: List[int]) -> List[List[int]]:
+        """Group coils into ranges that one write_coils frame can cover
+
+        Untouched coils inside a range are rewritten with their last known state,
+        so a range is only extended across coils whose state is known.
+        """
+        runs = []
+        for coil in coils:
+            if runs:
+                last = runs[-1][-1]
+                gaps = ((1 << coil) - 1) & ~((1 << (last + 1)) - 1)
+                if self._known & gaps == gaps:
+                    runs[-1].append(coil)
+                    continue
+            runs.append([coil])
+        return runs
+
+    def _fail(self, futures: List[asyncio.Future], exc: Exception) -> None:
+        for future in futures:
+            if not future.done():
+                future.set_exception(exc)
+
+    async def async_close(self) -> None:
+        """Drop the queued coil changes and cancel the writes in flight, failing whoever waits for them"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        self._fail([future for _, futures in pending.values() for future in futures],
+                   GatewayUnavailable(f"Switcher {self._slave_id} closed"))
+        writes = [*self._writes]
+        for task in writes:
+            task.cancel()
+        await asyncio.gather(*writes, return_exceptions=True)
+
+    async def _write_run(self, run: List[int], pending: Dict[int, Tuple[bool, List[asyncio.Future]]]) -> None:
+        start, end = run[0], run[-1]
+        values = [pending[coil][0] if coil in pending else bool(self._states >> coil & 1)
+                  for coil in range(start, end + 1)]
         try:
-            self._client = ModbusTcpClient(self._host, self._port, framer=ModbusRtuFramer)
-            self._available = True
+            if len(values) == 1:
+                await self._bus.run(partial(self._connection.call, "write_coil", start, values[0],
+                                            slave=self._slave_id), PRIORITY_WRITE)
+            else:
+                await self._bus.run(partial(self._connection.call, "write_coils", start, values,
+                                            slave=self._slave_id), PRIORITY_WRITE)
         except Exception as exc:
-            _LOGGER.error(f"ERROR: {exc} ")
-            self._available = False
-
-    def disconnect(self) -> None:
+            self._fail([future for coil in run for future in pending[coil][1]], exc)
+            return
+        except asyncio.CancelledError:
+            self._fail([future for coil in run for future in pending[coil][1]],
+                       GatewayUnavailable(f"Switcher {self._slave_id} closed"))
+            raise
+
+        states = mask = 0
+        for coil in run:
+            mask |= 1 << coil
+            if pending[coil][0]:
+                states |= 1 << coil
+        self._set_states(states, mask)
+        for coil in run:
+            for future in pending[coil][1]:
+                if not future.done():
+                    future.set_result(None)
+        for callback in self._write_callbacks:
+            callback()
+
+    async def update(self) -> int:
+        """Update switcher state, return the bitmask of the coils that changed"""
         try:
-            self._client.close()
-        except Exception as exc:
-            _LOGGER.error(f"ERROR: {exc} ")
-
-    def update(self) -> None:
-        """Update switcher state"""
-        try:
-            self.connect()
-            result = self._client.read_coils(0, self._count_of_coils, slave=self._slave_id)
-            self.disconnect()
-            for i in range(self._count_of_coils):
-                self._states[i] = result.bits[i]
-        except Exception as exc:
-            _LOGGER.error(f"ERROR: {exc} ")
-
+            result = await self._bus.run(
+                partial(self._connection.call, "read_coils", 0, self._count_of_coils, slave=self._slave_id),
+                PRIORITY_POLL)
+        except TRANSPORT_ERRORS + (GatewayUnavailable,):
+            # An error response still shows the module is reachable
+            self._set_available(False)
+            raise
+
+        states = 0
+        for coil, bit in enumerate(result.bits[:self._count_of_coils]):
+            if bit:
+                states |= 1 << coil
+        self._set_available(True)
+        return self._set_states(states, self._all_coils)
@@ -0,0 +1,191 @@
+"""Adaptive fixed-rate polling of the hub devices."""
+from __future__ import annotations
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Set
+from .breaker import GatewayUnavailable
+
+_LOGGER = logging.getLogger(__name__)
+
+# Results of a device poll
+UNCHANGED = 0
+CHANGED = 1
+BURST = 2
+
+MIN_INTERVAL = 0.5
+SLOWDOWN_FACTOR = 1.25
+MAX_SLOWDOWN = 4
+BOOST_FACTOR = 0.25
+# Polls a boost lasts before the interval returns to the configured one
+BOOST_POLLS = 5
+BACKOFF_MAX = 60
+# Refresh requests within this window after a requested poll collapse into one trailing poll
+REFRESH_COOLDOWN = 0.5
+
+
+class PollTarget:
+    """Poll interval and deadline of one device"""
+
+    def __init__(self, name: str, poll: Callable[[], Awaitable[int]], interval: float) -> None:
+        self.name = name
+        self.poll = poll
+        self.base_interval = interval
+        self.interval = interval
+        self.deadline = 0.0
+        self.failures = 0
+        self.running = False
+        self.boost_polls = 0
+        self.paused = False
+        # Loop time the last requested refresh is due at
+        self.requested_at = float("-inf")
+
+    def set_base_interval(self, interval: float) -> None:
+        """Change the configured interval"""
+        self.base_interval = interval
+        self.interval = interval
+        self.boost_polls = 0
+
+    def polled(self, result: int) -> None:
+        """Adapt the interval to the result of a successful poll"""
+        self.failures = 0
+        if result == BURST:
+            self.boost()
+            return
+        if self.boost_polls:
+            self.boost_polls -= 1
+            if self.boost_polls:
+                return
+            self.interval = self.base_interval
+        if result == CHANGED:
+            self.interval = self.base_interval
+        else:
+            self.interval = min(self.interval * SLOWDOWN_FACTOR, self.base_interval * MAX_SLOWDOWN)
+
+    def failed(self) -> None:
+        """Back off exponentially after a failed poll, never below the configured interval"""
+        self.failures += 1
+        self.boost_polls = 0
+        # Doubling the last interval cannot overflow, however many polls failed in a row
+        interval = self.base_interval if self.failures == 1 else self.interval
+        self.interval = min(interval * 2, max(BACKOFF_MAX, self.base_interval))
+
+    def boost(self) -> None:
+        """Poll faster for the next few polls"""
+        self.interval = max(self.base_interval * BOOST_FACTOR, MIN_INTERVAL)
+        self.boost_polls = BOOST_POLLS
+
+    def advance(self, now: float) -> None:
+        """Move the deadline by whole intervals so polls stay on a fixed grid"""
+        self.deadline += self.interval
+        if self.deadline <= now:
+            missed = (now - self.deadline) // self.interval + 1
+            self.deadline += missed * self.interval
+
+
+class PollScheduler:
+    """Runs every device poll on its own fixed-rate deadline"""
+
+    def __init__(self) -> None:
+        self._targets: Dict[str, PollTarget] = {}
+        self._wakeup = asyncio.Event()
+        self._polls: Set[asyncio.Task] = set()
+
+    @property
+    def targets(self) -> Dict[str, PollTarget]:
+        """Return the polled devices by name"""
+        return self._targets
+
+    def add(self, name: str, poll: Callable[[], Awaitable[int]], interval: float, paused: bool = False) -> None:
+        """Add a device poll, due at once unless paused"""
+        target = self._targets[name] = PollTarget(name, poll, interval)
+        target.deadline = asyncio.get_running_loop().time()
+        target.paused = paused
+        self._wakeup.set()
+
+    def set_paused(self, name: str, paused: bool) -> None:
+        """Stop polling a device nobody listens to, or start again
+
+        A resumed device is polled at once if its deadline passed meanwhile.
+        """
+        self._targets[name].paused = paused
+        self._wakeup.set()
+
+    def set_interval(self, name: str, interval: float) -> None:
+        """Change the configured interval of a device"""
+        target = self._targets[name]
+        target.set_base_interval(interval)
+        target.deadline = min(target.deadline, asyncio.get_running_loop().time() + interval)
+        self._wakeup.set()
+
+    def boost(self, name: str) -> None:
+        """Poll a device soon and faster for a while, e.g. after a write"""
+        self._targets[name].boost()
+        self.request_refresh(name)
+
+    def request_refresh(self, name: str) -> None:
+        """Poll a device at once, or once the cooldown after the last requested poll ended
+
+        However many requests arrive within the cooldown, they cause a single trailing poll.
+        """
+        target = self._targets[name]
+        now = asyncio.get_running_loop().time()
+        if target.requested_at > now:
+            # A trailing poll is already due
+            return
+        target.requested_at = max(now, target.requested_at + REFRESH_COOLDOWN)
+        target.deadline = min(target.deadline, target.requested_at)
+        self._wakeup.set()
+
+    async def run(self) -> None:
+        """Poll the devices forever
+
+        Every poll runs in its own task, so a long read of one device never holds
+        back the deadline of another; the bus scheduler orders their transactions.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                self._wakeup.clear()
+                idle = [target for target in self._targets.values() if not target.running and not target.paused]
+                if not idle:
+                    await self._wakeup.wait()
+                    continue
+
+                target = min(idle, key=lambda item: item.deadline)
+                delay = target.deadline - loop.time()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                target.running = True
+                task = loop.create_task(self._poll(target))
+                self._polls.add(task)
+                task.add_done_callback(self._polls.discard)
+        finally:
+            polls = list(self._polls)
+            for task in polls:
+                task.cancel()
+            await asyncio.gather(*polls, return_exceptions=True)
+
+    async def _poll(self, target: PollTarget) -> None:
+        started = asyncio.get_running_loop().time()
+        try:
+            target.polled(await target.poll())
+        except GatewayUnavailable:
+            # The breaker already logged it
+            target.failed()
+        except Exception as exc:
+            target.failed()
+            _LOGGER.error(f"{target.name}: {exc!r}")
+        finally:
+            target.running = False
+            now = asyncio.get_running_loop().time()
+            if target.requested_at > started:
+                # A refresh was requested while the poll ran, its data may predate the request
+                target.deadline = max(now, target.requested_at)
+            else:
+                target.advance(now)
+            self._wakeup.set()
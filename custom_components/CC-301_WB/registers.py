@@ -0,0 +1,92 @@
+"""Register map of the CC-301 values, driving decoding and entity creation."""
+from __future__ import annotations
+import struct
+from typing import Dict, List, NamedTuple, Sequence, Tuple
+from .frames import INSTANT_VALUES, RESPONSE_LENGTHS
+
+# How often a value needs to be read
+POLL_FAST = "fast"
+
+FLOAT_SIZE = 4
+
+# Home Assistant state classes
+MEASUREMENT = "measurement"
+TOTAL_INCREASING = "total_increasing"
+
+
+class Register(NamedTuple):
+    """One little-endian float in the response to a CC-301 command"""
+
+    name: str
+    command: Tuple[int, ...]
+    offset: int
+    scale: float = 1.0
+    unit: str | None = None
+    device_class: str | None = None
+    poll_class: str = POLL_FAST
+    state_class: str = MEASUREMENT
+
+
+REGISTERS: Tuple[Register, ...] = (
+    Register("summary_power", INSTANT_VALUES, 4, 50, "W", "power"),
+    Register("first_phase_power", INSTANT_VALUES, 8, 50, "W", "power"),
+    Register("second_phase_power", INSTANT_VALUES, 12, 50, "W", "power"),
+    Register("third_phase_power", INSTANT_VALUES, 16, 50, "W", "power"),
+    Register("first_phase_voltage", INSTANT_VALUES, 36, 1, "V", "voltage"),
+    Register("second_phase_voltage", INSTANT_VALUES, 40, 1, "V", "voltage"),
+    Register("third_phase_voltage", INSTANT_VALUES, 44, 1, "V", "voltage"),
+)
+
+
+def compile_decoder(registers: Sequence[Register]) -> struct.Struct:
+    """Return a struct that unpacks the registers, sorted by offset, and skips the bytes between them"""
+    parts = ["<"]
+    position = 0
+    run = 0
+    for register in registers:
+        if register.offset < position:
+            raise ValueError(f"Register {register.name} overlaps the previous one")
+        if register.offset > position:
+            if run:
+                parts.append(f"{run}f")
+                run = 0
+            parts.append(f"{register.offset - position}x")
+        run += 1
+        position = register.offset + FLOAT_SIZE
+    if run:
+        parts.append(f"{run}f")
+    return struct.Struct("".join(parts))
+
+
+class RegisterBlock:
+    """Registers read by one command and the compiled decoder of its response"""
+
+    def __init__(self, command: Tuple[int, ...], registers: Sequence[Register]) -> None:
+        self.command = command
+        self.response_length = RESPONSE_LENGTHS[command]
+        self.registers = tuple(sorted(registers, key=lambda register: register.offset))
+        self.names = tuple(register.name for register in self.registers)
+        self.poll_class = self.registers[0].poll_class
+        if any(register.poll_class != self.poll_class for register in self.registers):
+            raise ValueError(f"Registers of command {command} mix poll classes")
+        self._scales = tuple(register.scale for register in self.registers)
+        self.decoder = compile_decoder(self.registers)
+        if self.decoder.size > self.response_length:
+            raise ValueError(f"Registers of command {command} lie beyond its response")
+
+    def decode(self, frame) -> Tuple[Tuple[str, float], ...]:
+        """Return (name, scaled value) of every register in one pass over the frame"""
+        return tuple((name, raw * scale)
+                     for name, scale, raw in zip(self.names, self._scales, self.decoder.unpack_from(frame)))
+
+
+def compile_blocks(registers: Sequence[Register]) -> Tuple[RegisterBlock, ...]:
+    """Group the registers by command, keeping the order of the map"""
+    commands: Dict[Tuple[int, ...], List[Register]] = {}
+    for register in registers:
+        commands.setdefault(register.command, []).append(register)
+    return tuple(RegisterBlock(command, grouped) for command, grouped in commands.items())
+
+
+BLOCKS = compile_blocks(REGISTERS)
+POLL_CLASSES = tuple(dict.fromkeys(block.poll_class for block in BLOCKS))
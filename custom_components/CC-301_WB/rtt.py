@@ -0,0 +1,53 @@
+"""Round trip time estimate and the timeout derived from it, after RFC 6298."""
+from __future__ import annotations
+from typing import Dict
+
+ALPHA = 1 / 8
+BETA = 1 / 4
+K = 4
+# Floor of the variance term, so a perfectly steady link still gets some slack
+GRANULARITY = 0.01
+
+
+class RttEstimator:
+    """Smoothed round trip time and its variance for one kind of transaction"""
+
+    def __init__(self, min_timeout: float, max_timeout: float) -> None:
+        self._min_timeout = min_timeout
+        self._max_timeout = max_timeout
+        self.srtt: float | None = None
+        self.rttvar = 0.0
+        # Until the first sample nothing is known about the link
+        self._timeout = max_timeout
+
+    @property
+    def timeout(self) -> float:
+        """Return the current timeout"""
+        return self._timeout
+
+    def set_bounds(self, min_timeout: float, max_timeout: float) -> None:
+        """Change the bounds the timeout is clamped to"""
+        self._min_timeout = min_timeout
+        self._max_timeout = max_timeout
+        self._timeout = self._clamp(self._timeout if self.srtt is not None else max_timeout)
+
+    def sample(self, rtt: float) -> None:
+        """Update the estimate with the round trip time of an answered transaction"""
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+        self._timeout = self._clamp(self.srtt + max(GRANULARITY, K * self.rttvar))
+
+    def timed_out(self) -> None:
+        """Back off after a transaction went unanswered"""
+        self._timeout = self._clamp(self._timeout * 2)
+
+    def _clamp(self, timeout: float) -> float:
+        return min(max(timeout, self._min_timeout), self._max_timeout)
+
+    def as_dict(self) -> Dict[str, float | None]:
+        """Return the smoothed round trip time, its variance and the timeout"""
+        return {"srtt": self.srtt, "rttvar": self.rttvar, "timeout": self._timeout}
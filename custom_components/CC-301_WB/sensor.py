@@ -1,38 +1,76 @@
 """Platform for sensor integration."""
-from homeassistant.components.sensor import SensorEntity
-from homeassistant.helpers.entity import Entity
+from __future__ import annotations
+from homeassistant.components.sensor import (RestoreSensor, SensorDeviceClass, SensorEntity,
+                                             SensorEntityDescription, SensorStateClass)
+from homeassistant.const import UnitOfTime
+from homeassistant.core import callback
+from homeassistant.helpers.entity import EntityCategory
 from .const import DOMAIN
+from .registers import REGISTERS
+
+SENSOR_DESCRIPTIONS = tuple(
+    SensorEntityDescription(
+        key=register.name,
+        native_unit_of_measurement=register.unit,
+        device_class=SensorDeviceClass(register.device_class) if register.device_class else None,
+        state_class=SensorStateClass(register.state_class),
+    )
+    for register in REGISTERS
+)
+
+
+def _diagnostic(key: str, unit: str | None = None, counter: bool = False) -> SensorEntityDescription:
+    return SensorEntityDescription(
+        key=key,
+        native_unit_of_measurement=unit,
+        device_class=SensorDeviceClass.DURATION if unit else None,
+        state_class=SensorStateClass.TOTAL_INCREASING if counter else SensorStateClass.MEASUREMENT,
+        entity_category=EntityCategory.DIAGNOSTIC,
+        entity_registry_enabled_default=False,
+    )
+
+
+GATEWAY_SENSOR_DESCRIPTIONS = (
+    _diagnostic("transactions", counter=True),
+    _diagnostic("rtt_average", UnitOfTime.MILLISECONDS),
+    _diagnostic("rtt_p99", UnitOfTime.MILLISECONDS),
+    _diagnostic("timeouts", counter=True),
+    _diagnostic("crc_failures", counter=True),
+    _diagnostic("short_reads", counter=True),
+    _diagnostic("errors", counter=True),
+    _diagnostic("reconnects", counter=True),
+    _diagnostic("queue_wait", UnitOfTime.MILLISECONDS),
+    _diagnostic("queue_depth"),
+)
 
 
 async def async_setup_entry(hass, config_entry, async_add_entities):
     """Add sensors for passed config_entry in HA."""
     hub = hass.data[DOMAIN][config_entry.entry_id]
 
-    new_devices = []
-    device = hub.devices[0]
-    new_devices.append(ElectricMeter(device, device.electric_meter.summary_power, "summary_power"))
-    new_devices.append(ElectricMeter(device, device.electric_meter.first_phase_power, "first_phase_power"))
-    new_devices.append(ElectricMeter(device, device.electric_meter.second_phase_power, "second_phase_power"))
-    new_devices.append(ElectricMeter(device, device.electric_meter.third_phase_power, "third_phase_power"))
-    new_devices.append(ElectricMeter(device, device.electric_meter.first_phase_voltage, "first_phase_voltage"))
-    new_devices.append(ElectricMeter(device, device.electric_meter.second_phase_voltage, "second_phase_voltage"))
-    new_devices.append(ElectricMeter(device, device.electric_meter.third_phase_voltage, "third_phase_voltage"))
+    new_devices = [ElectricMeter(device, description)
+                   for device in hub.meters
+                   for description in SENSOR_DESCRIPTIONS]
+    new_devices += [GatewaySensor(hub, description) for description in GATEWAY_SENSOR_DESCRIPTIONS]
 
     if new_devices:
         async_add_entities(new_devices)
 
 
-class ElectricMeter(Entity):
+class ElectricMeter(RestoreSensor):
     """Representation of a Sensor."""
 
     should_poll = False
 
-    def __init__(self, device, result_function, name):
+    def __init__(self, device, description: SensorEntityDescription):
         """Initialize the sensor."""
         self._device = device
-        self._attr_unique_id = f"{self._device.name}_{name}"
-        self._attr_name = f"{self._device.name} {name}"
-        self._result_function = result_function
+        self.entity_description = description
+        self._attr_unique_id = f"{self._device.id}_{description.key}"
+        self._attr_name = f"{self._device.name} {description.key}"
+        self._field = description.key
+        # Value from before the restart, shown until the first poll confirms or fails
+        self._restored = None
 
     @property
     def device_info(self):
@@ -45,20 +83,56 @@ class ElectricMeter(Entity):
         }
 
     @property
-    def state(self):
+    def native_value(self):
         """Return the state of the sensor."""
-        return self._result_function()
+        if self._restored is not None:
+            return self._restored
+        return self._device.electric_meter.value(self._field)
 
     @property
     def available(self):
         """Return True if meter is available"""
-        return self._device.electric_meter.available
+        return self._restored is not None or self._device.electric_meter.available
+
+    @property
+    def extra_state_attributes(self):
+        """Flag a restored value that no poll confirmed yet."""
+        return {"stale": True} if self._restored is not None else None
 
     async def async_added_to_hass(self):
         """Run when this Entity has been added to HA."""
+        if not self._device.polled:
+            last = await self.async_get_last_sensor_data()
+            if last is not None:
+                self._restored = last.native_value
         # Sensors should also register callbacks to HA when their state changes
-        self._device.register_callback(self.async_write_ha_state)
+        self._device.register_callback(self._handle_update, self._field)
 
     async def async_will_remove_from_hass(self):
         """Entity being removed from hass."""
-        self._device.remove_callback(self.async_write_ha_state)
+        self._device.remove_callback(self._handle_update, self._field)
+
+    @callback
+    def _handle_update(self) -> None:
+        """Drop the restored value once a poll read the field or failed, then write the state."""
+        meter = self._device.electric_meter
+        if meter.value(self._field) is not None or not meter.available:
+            self._restored = None
+        self.async_write_ha_state()
+
+
+class GatewaySensor(SensorEntity):
+    """Transaction figure of a gateway, read from memory on every poll"""
+
+    def __init__(self, hub, description: SensorEntityDescription):
+        """Initialize the sensor."""
+        self._hub = hub
+        self.entity_description = description
+        self._attr_unique_id = f"gateway_{hub.hub_id}_{description.key}"
+        self._attr_name = f"{hub.device_info['name']} {description.key}"
+        self._attr_device_info = hub.device_info
+
+    @property
+    def native_value(self):
+        """Return the state of the sensor."""
+        return self._hub.diagnostic_values()[self.entity_description.key]
@@ -0,0 +1,107 @@
+"""Reloading a hub must leave exactly one poll task and one gateway connection behind, and no write."""
+from __future__ import annotations
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "benchmarks"))
+
+from _component import load  # noqa: E402
+from simulator import Faults, GatewaySimulator  # noqa: E402
+
+breaker_module = load("breaker")
+connection_module = load("connection")
+const_module = load("const")
+hub_module = load("hub")
+
+CYCLES = 5
+# Long enough for every device to be polled at least once
+RUN_TIME = 0.3
+
+
+def poll_tasks():
+    """Return the running poll supervisors of all hubs"""
+    return [task for task in asyncio.all_tasks()
+            if not task.done() and task.get_coro().__qualname__ == "Hub._run_polls"]
+
+
+def create_hub(port: int):
+    """Create a hub whose devices are polled, as if their entities listened"""
+    hub = hub_module.Hub(None, "test", "127.0.0.1", str(port), ["5"], [[1, 8]], {})
+
+    def listener():
+        pass
+
+    for meter in hub.meters:
+        for field in meter.electric_meter.FIELDS:
+            meter.register_callback(listener, field)
+    for relay in hub.relays:
+        for coil in range(relay.count_of_coils):
+            relay.register_callback(listener, coil)
+    return hub
+
+
+async def reload_cycles() -> None:
+    simulator = GatewaySimulator((5,), ((1, 8),))
+    port = await simulator.start()
+    try:
+        hub = create_hub(port)
+        connection = hub.connection
+        for _ in range(CYCLES):
+            await asyncio.sleep(RUN_TIME)
+            await hub.async_close()
+            assert not hub.polling
+            hub = create_hub(port)
+            assert hub.connection is connection
+            assert len(poll_tasks()) == 1
+            assert len(connection_module._CONNECTIONS) == 1
+        await asyncio.sleep(RUN_TIME)
+        assert hub.meters[0].polled
+        await hub.async_close()
+        assert poll_tasks() == []
+        # Skip the linger of the released connection
+        connection._close_handle.cancel()
+        await connection_module._close(connection)
+        assert connection_module._CONNECTIONS == {}
+    finally:
+        await simulator.stop()
+
+
+def test_reload_keeps_one_poll_task_and_one_connection():
+    asyncio.run(reload_cycles())
+
+
+async def close_while_toggling(latency: float) -> None:
+    simulator = GatewaySimulator((5,), ((1, 8),), Faults(latency=latency))
+    port = await simulator.start()
+    try:
+        hub = create_hub(port)
+        connection = hub.connection
+        await asyncio.sleep(RUN_TIME)
+        toggle = asyncio.create_task(hub.relays[0].modbus_switcher.turn_on(3))
+        # Close inside the coalescing window, or once the write is on the bus
+        await asyncio.sleep(0 if not latency else const_module.WRITE_COALESCE_WINDOW + latency / 2)
+        await hub.async_close()
+        connection._close_handle.cancel()
+        await connection_module._close(connection)
+        # Past the coalescing window and the answer of a write that was not stopped
+        await asyncio.sleep(const_module.WRITE_COALESCE_WINDOW + 2 * latency + 0.1)
+        assert toggle.done()
+        assert isinstance(toggle.exception(), breaker_module.GatewayUnavailable)
+        assert hub.relays[0].modbus_switcher._writes == set()
+        assert hub._bus._worker is None
+        assert not connection._client.connected
+        if not latency:
+            # A frame already sent cannot be taken back, but one still being coalesced is never sent
+            assert simulator.relays[1].states == 0
+        assert poll_tasks() == []
+    finally:
+        await simulator.stop()
+
+
+def test_close_fails_a_write_waiting_to_be_coalesced():
+    asyncio.run(close_while_toggling(0.0))
+
+
+def test_close_fails_a_write_on_the_bus():
+    asyncio.run(close_while_toggling(0.2))